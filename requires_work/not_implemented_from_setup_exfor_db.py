@@ -43,8 +43,7 @@
 #   Single entry/subentry/transaction management
 # ------------------------------------------------------
 
-# Not Implemented Yet
-# use exfor_utilities.py's chunkifyX4Request() to split up a TRANS or REQUEST
+# Implemented for TRANS files in x4i3tools/transactions.py (--apply-trans)
 
 
 # ------------------------------------------------------
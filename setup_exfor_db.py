@@ -113,6 +113,15 @@ def view_errors():
                 print(55 * " ", " ", 4 * " ", " ", example, " ", entry)
 
 
+def parse_size(size):
+    """Convert a size like 512M or 4G to bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def make_tarfile(output_filename, source_dir):
     import tarfile
 
@@ -145,6 +154,30 @@ if __name__ == "__main__":
         dest="ncpu",
         help="Set number of threads in multiprocessing. Default is number of threads.",
     )
+    parser.add_argument(
+        "--max-memory",
+        metavar="SIZE",
+        type=parse_size,
+        default=None,
+        help="Memory ceiling of the main process (e.g. 4G). Beyond it, no new "
+        + "work is dispatched until the buffered results have been written out.",
+    )
+    parser.add_argument(
+        "--entry-timeout",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Time budget for parsing a single entry. Entries over budget are "
+        + "given up and listed among the errors.",
+    )
+    parser.add_argument(
+        "--max-worker-memory",
+        metavar="SIZE",
+        type=parse_size,
+        default=None,
+        help="Restart the index workers once one of them uses more memory than "
+        + "this (e.g. 2G).",
+    )
 
     # ------- Control over update actions -------
     parser.add_argument(
@@ -154,6 +187,84 @@ if __name__ == "__main__":
         help="Just (re)builds the sqlite database indexing the EXFOR data "
         + "in the project. The EXFOR data must be already unpacked.",
     )
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        default=False,
+        help="Extract the entries of an X4 master file to disk (X4all). This is "
+        + "not required for building the index, which reads the entries "
+        + "directly from the zip file.",
+    )
+    parser.add_argument(
+        "--packed-store",
+        action="store_true",
+        default=False,
+        help="Store the entries in a single packed file with an offset index "
+        + "(db.x4pack) instead of one .x4 file per entry in the db/NNN/ tree.",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        default=False,
+        help="Compress every entry in the packed store (zlib). Implies "
+        + "--packed-store.",
+    )
+    parser.add_argument(
+        "--update-from",
+        metavar="UNPACKDIR",
+        type=str,
+        default=None,
+        help="Unpack incrementally on top of the unpack directory of a previous "
+        + "master (unpack_<previous master>), whose tree is moved into place. Only "
+        + "added, changed or removed entries are written, and listed in "
+        + "unpack-changes.json.",
+    )
+    parser.add_argument(
+        "--parse-cache",
+        metavar="CACHEFILE",
+        type=str,
+        default=None,
+        help="Reuse the parsed entries stored in this sqlite file, keyed by the "
+        + "content of the entry and the x4i3/x4i3tools versions, and add the "
+        + "newly parsed ones. Can be shared between the builds of different "
+        + "masters.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Update the existing index instead of rebuilding it. Only new, "
+        + "modified or removed entries are re-indexed. With --update-from the "
+        + "index of the previous master is moved over, along with its tree if "
+        + "it was unpacked.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Resume an interrupted index build from its checkpoint, only the "
+        + "entries that are not yet in the index are parsed.",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="SHARD",
+        type=str,
+        default=None,
+        help="Only index the entries of one shard, either a comma separated list "
+        + "of 3-digit directories (e.g. 128,E07) or K/N for the K-th of N shards "
+        + "balanced by size (counting from 0). The shard is written to "
+        + "<database>/shards/ and can be built on another host sharing the "
+        + "filesystem. Combine the shards with --merge-shards.",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        metavar="SHARDDIR",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Merge the given index shards (all in <database>/shards/ if none "
+        + "are given) into the index of the database.",
+    )
     parser.add_argument(
         "--just-unpack",
         action="store_true",
@@ -162,6 +273,15 @@ if __name__ == "__main__":
         + "sqlite database index.",
     )
 
+    parser.add_argument(
+        "--apply-trans",
+        metavar="TRANSFILE",
+        type=str,
+        default=None,
+        help="Apply an IAEA TRANS file to the unpacked EXFOR data and update "
+        + "the index of only the affected entries in place.",
+    )
+
     # ------- View/save logs -------
     parser.add_argument(
         "--view-errors",
@@ -221,6 +341,33 @@ if __name__ == "__main__":
         help="Reinstall the EXFOR doi <-> entry mapping using the contents "
         + "from this IAEA EXFOR dictionary text file.",
     )
+    parser.add_argument(
+        "--benchmark-queries",
+        action="store_true",
+        default=False,
+        help="Time the x4i3 searches on the index and show their query plans.",
+    )
+    parser.add_argument(
+        "--data-store",
+        action="store_true",
+        default=False,
+        help="Write the DATA and COMMON sections to a columnar store of NumPy "
+        + "arrays (data-columns.npack) after building or updating the index. "
+        + "An existing store is updated. Requires numpy.",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        default=False,
+        help="Print the largest rows of the aggregate tables of the index.",
+    )
+    parser.add_argument(
+        "--search-bib",
+        metavar="QUERY",
+        default=None,
+        help="Full-text search of the BIB sections in the index with an FTS5 "
+        + """query, e.g. '"time-of-flight" AND geel'.""",
+    )
     parser.add_argument(
         "--create-x4i3-tarfile",
         action="store_true",
@@ -228,6 +375,12 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    args.packed_store = args.packed_store or args.compress
+    if args.packed_store and args.update_from is not None:
+        # The packed store is rewritten as a whole and has no unpack manifest
+        parser.error("--update-from can not be combined with --packed-store")
+    if args.packed_store and args.create_x4i3_tarfile:
+        parser.error("x4i3 can not load the packed store of --packed-store")
 
     # Set verbosity level
     x4i3tools.verbose = args.verbose
@@ -236,6 +389,23 @@ if __name__ == "__main__":
     x4i3tools.force = args.force
     # Number of cores
     x4i3tools.nthreads = args.ncpu if args.ncpu > 0 else x4i3tools.nthreads
+    # Memory ceiling
+    x4i3tools.max_memory = args.max_memory
+    # Budgets of the index workers
+    x4i3tools.entry_timeout = args.entry_timeout
+    x4i3tools.max_worker_memory = args.max_worker_memory
+    if (
+        args.max_memory is not None or args.max_worker_memory is not None
+    ) and x4i3tools.current_rss() is None:
+        print(
+            "Can not measure the memory of a process on this platform, install "
+            + "psutil. --max-memory and --max-worker-memory are ignored."
+        )
+    # Parse cache
+    if args.parse_cache is not None:
+        from x4i3tools.parse_cache import ParseCache
+
+        x4i3tools.parse_cache = ParseCache(args.parse_cache)
 
     assert (
         args.exfor_master is not None or args.X4_master is not None
@@ -247,14 +417,28 @@ if __name__ == "__main__":
         x4_db_fname = args.exfor_master
         dbdir = "db"
     else:
+        from x4i3tools.entry_sources import ZipEntrySource
         from x4i3tools.fileops import unpackX4Master as unpack_func
 
         x4_db_fname = args.X4_master
         dbdir = "X4all"
+        x4i3tools.currentEntrySource = ZipEntrySource(x4_db_fname)
 
     # Set paths for all operations
     current_path, x4i3_db_dir = x4i3tools.set_current_dir(x4_db_fname, create=False)
-    # x4i3tools.currentDBPath = os.path.join(current_path, dbdir)
+    if args.X4_master is not None:
+        x4i3tools.currentDBPath = current_path / dbdir
+    if args.packed_store:
+        from x4i3tools.entry_sources import PackedEntrySource
+
+        x4i3tools.currentEntrySource = PackedEntrySource(
+            x4i3tools.currentPackedStoreFileName
+        )
+
+    if args.incremental and args.update_from:
+        from x4i3tools.fileops import move_previous_index
+
+        move_previous_index(args.update_from)
 
     if not (
         args.just_build_index
@@ -262,8 +446,19 @@ if __name__ == "__main__":
         or args.error_log
         or args.view_errors
         or args.create_x4i3_tarfile
-    ):
-        unpack_func(x4_db_fname)
+        or args.apply_trans
+        or args.benchmark_queries
+        or args.search_bib is not None
+        or args.summary
+        or args.shard is not None
+        or args.merge_shards is not None
+    ) and (args.exfor_master is not None or args.extract or args.packed_store):
+        unpack_func(
+            x4_db_fname,
+            packed=args.packed_store,
+            previousDir=args.update_from,
+            compress=args.compress,
+        )
 
     if not (
         args.just_unpack
@@ -271,17 +466,75 @@ if __name__ == "__main__":
         or args.error_log
         or args.view_errors
         or args.create_x4i3_tarfile
+        or args.apply_trans
+        or args.benchmark_queries
+        or args.search_bib is not None
+        or args.summary
+        or args.merge_shards is not None
     ):
         from x4i3tools.index_generators import buildMainIndex, insertDOIIndex
 
-        buildMainIndex()
+        if args.shard is not None:
+            x4i3tools.set_current_shard(args.shard)
+        buildMainIndex(
+            incremental=args.incremental, resume=args.resume, shard=args.shard
+        )
+        if args.shard is None:
+            insertDOIIndex()
+
+    if args.merge_shards is not None:
+        from x4i3tools.index_generators import insertDOIIndex, merge_index_shards
+
+        shard_dirs = args.merge_shards or sorted(
+            (x4i3_db_dir / "shards").glob("shard-*")
+        )
+        merge_index_shards(shard_dirs)
         insertDOIIndex()
 
+    if args.apply_trans:
+        from x4i3tools.transactions import apply_trans_file
+
+        apply_trans_file(args.apply_trans)
+
     if args.doi:
         from x4i3tools.index_generators import insertDOIIndex
 
         insertDOIIndex()
 
+    if args.data_store and args.shard is None:
+        from x4i3tools.data_store import write_data_store
+        from x4i3tools.entry_sources import DirectoryEntrySource
+
+        write_data_store(
+            x4i3tools.currentEntrySource
+            or DirectoryEntrySource(x4i3tools.currentDBPath),
+            x4i3tools.currentDataStoreFileName,
+        )
+
+    if args.benchmark_queries:
+        from x4i3tools.index_generators import benchmark_index_queries
+
+        benchmark_index_queries()
+
+    if args.summary:
+        from x4i3tools.index_generators import print_index_summary
+
+        print_index_summary()
+
+    if args.search_bib is not None:
+        import time
+        from x4i3tools.index_generators import search_bib_text
+
+        start = time.time()
+        matches = search_bib_text(args.search_bib)
+        for entry, subent in matches:
+            print(entry, subent)
+        print(
+            "{0} subentries found in {1:.3f} ms".format(
+                len(matches), 1e3 * (time.time() - start)
+            )
+        )
+
     if args.view_errors:
         view_errors()
 
@@ -289,4 +542,13 @@ if __name__ == "__main__":
         report_errors(str(current_path) + ".csv")
 
     if args.create_x4i3_tarfile:
+        if not os.path.exists(x4i3tools.currentDBPath) and os.path.exists(
+            x4i3tools.currentPackedStoreFileName
+        ):
+            parser.error(
+                "Only a packed store was written to {0}, x4i3 can not load it. ".format(
+                    x4i3_db_dir
+                )
+                + "Unpack the master without --packed-store first."
+            )
         make_tarfile("x4i3_" + x4i3_db_dir.name + ".tar.gz", x4i3_db_dir)
@@ -0,0 +1,50 @@
+import time
+from multiprocessing import Pool
+
+import pytest
+
+import x4i3tools as x4t
+
+
+def slow_first(i):
+    """Task 0 finishes last."""
+    if i == 0:
+        time.sleep(0.5)
+    return i
+
+
+def test_ordered_keeps_the_order_of_the_input():
+    with Pool(2) as mpool:
+        results = list(
+            x4t.imap_bounded(mpool, slow_first, range(6), max_pending=6, ordered=True)
+        )
+    assert results == list(range(6))
+
+
+def test_unordered_returns_in_order_of_completion():
+    with Pool(2) as mpool:
+        results = list(
+            x4t.imap_bounded(mpool, slow_first, range(6), max_pending=6, ordered=False)
+        )
+    assert sorted(results) == list(range(6))
+    assert results[-1] == 0
+
+
+def test_bounded_number_of_pending_tasks():
+    consumed = []
+
+    def source():
+        for i in range(20):
+            consumed.append(i)
+            yield i
+
+    with Pool(2) as mpool:
+        for result in x4t.imap_bounded(mpool, abs, source(), max_pending=3):
+            # The input is read at most max_pending tasks ahead of the results
+            assert len(consumed) <= result + 1 + 3
+
+
+def test_unordered_raises_errors_of_the_tasks():
+    with Pool(2) as mpool:
+        with pytest.raises(TypeError):
+            list(x4t.imap_bounded(mpool, abs, ["a"], ordered=False))
@@ -0,0 +1,104 @@
+import pathlib
+import pickle
+import sqlite3
+import zipfile
+
+import pytest
+import x4i3
+
+import x4i3tools as x4t
+from x4i3tools.fileops import move_previous_index, unpackEXFORMaster
+from x4i3tools.index_generators import buildMainIndex
+
+# Entries shipped with the tests of x4i3
+testEntries = pathlib.Path(x4i3.__file__).parent / "tests"
+
+
+def read_entry(accnum, as_accnum=None):
+    """The text of a test entry, renumbered to ``as_accnum``."""
+    path = testEntries / (accnum + ".x4")
+    if not path.exists():
+        pytest.skip("The test entries of x4i3 are not installed")
+    text = path.read_text(encoding="latin1")
+    return text.replace(accnum, as_accnum) if as_accnum else text
+
+
+def write_master(directory, name, entries):
+    """A tiny EXFOR master, a zip file with a .bck file of ``entries``."""
+    master = directory / (name + ".zip")
+    with zipfile.ZipFile(master, "w") as zip_ref:
+        zip_ref.writestr(name + ".bck", "REQUEST  header\n" + "".join(entries))
+    return master
+
+
+def build(master, previous=None):
+    """Unpack and index a master, incrementally on top of ``previous``."""
+    x4t.set_current_dir(master)
+    if previous is not None:
+        move_previous_index(previous)
+    unpackEXFORMaster(master, previousDir=previous)
+    buildMainIndex(incremental=previous is not None)
+
+
+def index_content():
+    """Everything in the index and the pickles but the modification times."""
+    connection = sqlite3.connect(x4t.currentIndexFileName)
+    tables = ["theworks", "entryreactions", "entryyears", "bibtext"] + [
+        name
+        for (name,) in connection.execute(
+            "select name from sqlite_master"
+            " where type = 'table' and name like 'summary_%'"
+        )
+    ]
+    content = {
+        table: sorted(connection.execute("select * from " + table), key=repr)
+        for table in tables
+    }
+    content["entrystate"] = sorted(
+        connection.execute("select entry, name, hash, size from entrystate")
+    )
+    connection.close()
+    for file_name in [
+        x4t.currentCoupledFileName,
+        x4t.currentMonitoredFileName,
+        x4t.currentReactionCountFileName,
+        x4t.currentErrorFileName,
+    ]:
+        with open(file_name, mode="rb") as f:
+            content[pathlib.Path(file_name).name] = pickle.load(f)
+    # Exceptions do not compare equal, their messages do
+    content["errors"] = {
+        k: message for k, (_, message) in content.pop(x4i3.errorFileName).items()
+    }
+    return content
+
+
+def test_incremental_build_equals_full_rebuild(tmp_path, monkeypatch):
+    monkeypatch.setattr(x4t, "nthreads", 2)
+    monkeypatch.setattr(x4t, "force", False)
+    monkeypatch.setattr(x4t, "currentEntrySource", None)
+    monkeypatch.setattr(x4t, "parse_cache", None)
+
+    changed = read_entry("E0783").replace("PLANEBY", "PLANE BY")
+    assert changed != read_entry("E0783")
+    first = write_master(
+        tmp_path,
+        "EXFOR-2000-01-01",
+        [read_entry("12898", "12897"), read_entry("12898"), read_entry("E0783")],
+    )
+    # 12897 is unchanged, 12898 removed, E0783 modified and 12899 added
+    second = write_master(
+        tmp_path,
+        "EXFOR-2000-02-01",
+        [read_entry("12898", "12897"), changed, read_entry("12898", "12899")],
+    )
+
+    build(first)
+    build(second, previous=first.parent / ("unpack_" + first.stem))
+    incremental = index_content()
+    assert incremental["theworks"]
+    assert [row[0] for row in incremental["entrystate"]] == ["12897", "12899", "E0783"]
+
+    monkeypatch.setattr(x4t, "force", True)
+    buildMainIndex()
+    assert incremental == index_content()
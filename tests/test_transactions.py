@@ -0,0 +1,85 @@
+from x4i3tools.transactions import merge_trans_entry, split_entry
+
+
+def record(tag, accnum="", count=""):
+    """A record of an EXFOR file with the keyword and the accession number."""
+    return tag.ljust(14) + accnum.ljust(8) + count.rjust(11) + "\n"
+
+
+def subentry(accnum, *lines):
+    return [record("SUBENT", accnum)] + list(lines) + [record("ENDSUBENT")]
+
+
+def entry(accnum, *subentries, nosubents=()):
+    lines = [record("ENTRY", accnum)]
+    for subent in subentries:
+        lines += subent
+    lines += [record("NOSUBENT", s) for s in nosubents]
+    return lines + ["ENDENTRY".ljust(11) + str(len(subentries)).rjust(11) + "\n"]
+
+
+def count_of(lines):
+    assert lines[-1].startswith("ENDENTRY")
+    return int(lines[-1][11:22])
+
+
+def test_split_entry():
+    lines = entry(
+        "12345",
+        subentry("12345001", "BIB\n"),
+        subentry("12345002", "DATA\n"),
+        nosubents=["12345003"],
+    )
+    header, subentries, footer = split_entry(lines)
+    assert header == lines[0]
+    assert footer == lines[-1]
+    assert sorted(subentries) == ["12345001", "12345002", "12345003"]
+    assert subentries["12345002"] == subentry("12345002", "DATA\n")
+    assert subentries["12345003"] == [record("NOSUBENT", "12345003")]
+
+
+def test_merge_replaces_and_adds_subentries():
+    old = entry(
+        "12345", subentry("12345001", "old BIB\n"), subentry("12345002", "old\n")
+    )
+    trans = entry(
+        "12345", subentry("12345002", "new\n"), subentry("12345003", "added\n")
+    )
+    merged = merge_trans_entry(old, trans)
+    _, subentries, _ = split_entry(merged)
+    assert subentries["12345001"] == subentry("12345001", "old BIB\n")
+    assert subentries["12345002"] == subentry("12345002", "new\n")
+    assert subentries["12345003"] == subentry("12345003", "added\n")
+    assert count_of(merged) == 3
+
+
+def test_merge_nosubent_deletes_subentry():
+    old = entry(
+        "12345", subentry("12345001", "BIB\n"), subentry("12345002", "DATA\n")
+    )
+    trans = entry("12345", nosubents=["12345002"])
+    merged = merge_trans_entry(old, trans)
+    assert not any(line.startswith("SUBENT        12345002") for line in merged)
+    # The NOSUBENT record is kept, but not counted
+    assert record("NOSUBENT", "12345002") in merged
+    assert count_of(merged) == 1
+
+
+def test_merge_deletes_entry_without_subentries():
+    old = entry("12345", subentry("12345001", "BIB\n"))
+    trans = entry("12345", nosubents=["12345001"])
+    assert merge_trans_entry(old, trans) is None
+
+
+def test_merge_new_entry():
+    trans = entry("12345", subentry("12345001", "BIB\n"))
+    merged = merge_trans_entry(None, trans)
+    assert merged == trans
+    assert count_of(merged) == 1
+
+
+def test_merge_without_endentry_adds_one():
+    trans = entry("12345", subentry("12345001", "BIB\n"))[:-1]
+    merged = merge_trans_entry(None, trans)
+    assert merged[-1].startswith("ENDENTRY")
+    assert count_of(merged) == 1
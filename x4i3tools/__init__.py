@@ -1,6 +1,8 @@
 # import os
+import hashlib
 import pathlib
-from collections import namedtuple
+from collections import deque, namedtuple
+from itertools import islice
 from multiprocessing import cpu_count
 
 from x4i3 import (
@@ -12,14 +14,32 @@ from x4i3 import (
     dbPath,
 )
 
+__version__ = "0.2.0"
+
 buggyEntries = {}
 coupledReactionEntries = {}
 monitoredReactionEntries = {}
 reactionCount = {}
 
+# Single-file alternative to the db/NNN/NNNNN.x4 tree
+packedStoreFileName = "db.x4pack"
+# Columnar store of the DATA and COMMON sections (x4i3tools.data_store)
+dataStoreFileName = "data-columns.npack"
+
+# Content hashes of the unpacked entries and the changes w.r.t. the previous unpack
+manifestFileName = "unpack-manifest.json"
+changesFileName = "unpack-changes.json"
+
 verbose = False
 force = False
 nthreads = int(cpu_count() * 0.75)
+# Memory ceiling (bytes) of the parent process, beyond which no new work is
+# dispatched to the pools until buffered results have been consumed
+max_memory = None
+# Time budget (seconds) for parsing a single entry
+entry_timeout = None
+# Memory (bytes) of an index worker beyond which the pool is recycled
+max_worker_memory = None
 
 currentIndexFileName = None
 currentErrorFileName = None
@@ -27,6 +47,13 @@ currentCoupledFileName = None
 currentMonitoredFileName = None
 currentReactionCountFileName = None
 currentDBPath = None
+currentPackedStoreFileName = None
+currentDataStoreFileName = None
+currentManifestFileName = None
+currentChangesFileName = None
+currentEntrySource = None
+# Cache of parsed entries shared across builds (x4i3tools.parse_cache.ParseCache)
+parse_cache = None
 
 
 def recreate_dir(path, force):
@@ -40,15 +67,137 @@ def recreate_dir(path, force):
 
 
 def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+    """Yield successive n-sized chunks (as lists) from lst or any iterable.
+
+    Iterables are consumed lazily, one chunk at a time.
+    """
+    it = iter(lst)
+    chunk = list(islice(it, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, n))
+
+
+def current_rss():
+    """
+    Resident memory of the current process in bytes, or None where only the
+    peak usage can be measured (no psutil and no /proc).
+    """
+    import os
+
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # getrusage only reports the peak, which never goes down
+        return None
+
+
+def above_memory(rss, ceiling):
+    """True if a ceiling is set and the measured memory ``rss`` exceeds it."""
+    return ceiling is not None and rss is not None and rss > ceiling
+
+
+def imap_bounded(mpool, func, iterable, max_pending=None, ordered=True):
+    """Like ``mpool.imap`` but keeps at most ``max_pending`` tasks in flight.
+
+    ``Pool.imap`` drains its input in a feeder thread as fast as it can, which
+    would pull a lazily generated input (e.g. a multi-hundred-MB master file)
+    completely into memory. Here the next task is only submitted once one of
+    the pending results has been handed back to the caller. While the parent
+    process is above ``max_memory``, results are handed back (and are expected
+    to be flushed by the caller) before anything new is dispatched.
+
+    With ``ordered=False`` results are handed back in order of completion, like
+    ``mpool.imap_unordered``.
+    """
+    import queue
+
+    if max_pending is None:
+        max_pending = 2 * nthreads
+    pending = deque()
+    done = queue.Queue()
+
+    def next_result():
+        if ordered:
+            return pending.popleft().get()
+        pending.pop()
+        success, value = done.get()
+        if not success:
+            raise value
+        return value
+
+    for args in iterable:
+        while pending and (
+            len(pending) >= max_pending
+            or above_memory(current_rss(), max_memory)
+        ):
+            yield next_result()
+        if ordered:
+            # The results are only referenced by their AsyncResult
+            pending.append(mpool.apply_async(func, (args,)))
+        else:
+            pending.append(
+                mpool.apply_async(
+                    func,
+                    (args,),
+                    callback=lambda value: done.put((True, value)),
+                    error_callback=lambda err: done.put((False, err)),
+                )
+            )
+    while pending:
+        yield next_result()
+
+
+# Handles (zip files, memory maps, sqlite connections) opened by the current
+# process, never shared with forked children
+_process_handles = {}
+
+
+def process_handle(key, opener):
+    """
+    The handle of the current process for ``key``, opened with ``opener()`` on
+    first use. Entry sources, stores and caches are handed to the pool
+    workers, every process opens its own handles.
+    """
+    import os
+
+    key = (os.getpid(),) + tuple(key)
+    if key not in _process_handles:
+        _process_handles[key] = opener()
+    return _process_handles[key]
+
+
+def forget_process_handle(key):
+    """Drop the handle of the current process for ``key`` and return it, or None."""
+    import os
+
+    return _process_handles.pop((os.getpid(),) + tuple(key), None)
+
+
+def store_index_file_name(storeFileName):
+    """The index next to a packed file, of entries or of DATA/COMMON sections."""
+    storeFileName = pathlib.Path(storeFileName)
+    return storeFileName.with_name(storeFileName.name + ".index")
+
+
+def content_hash(data):
+    """Hash identifying the content (bytes) of an entry."""
+    return hashlib.sha1(data).hexdigest()
 
 
 def set_current_dir(master_file, create=False):
     global currentIndexFileName, currentErrorFileName
     global currentCoupledFileName, currentMonitoredFileName
     global currentReactionCountFileName, currentDBPath
+    global currentPackedStoreFileName, currentManifestFileName, currentChangesFileName
+    global currentDataStoreFileName
 
     # Create target directory
     master_file = pathlib.Path(master_file)
@@ -68,6 +217,11 @@ def set_current_dir(master_file, create=False):
     currentMonitoredFileName = x4i3_db_dir / monitoredFileName
     currentReactionCountFileName = x4i3_db_dir / reactionCountFileName
     currentDBPath = x4i3_db_dir / dbPath
+    currentPackedStoreFileName = x4i3_db_dir / packedStoreFileName
+    currentDataStoreFileName = x4i3_db_dir / dataStoreFileName
+    # The manifest describes the unpacked tree, it is not part of the x4i3 database
+    currentManifestFileName = unpacked_dir / manifestFileName
+    currentChangesFileName = unpacked_dir / changesFileName
 
     # Create tag file
     pathlib.Path(x4i3_db_dir / tag).touch(exist_ok=True)
@@ -75,6 +229,33 @@ def set_current_dir(master_file, create=False):
     return unpacked_dir, x4i3_db_dir
 
 
+def shard_name(shard):
+    """Directory name of an index shard, "3/8" or a list of directories "128,E07"."""
+    return "shard-" + shard.replace("/", "of").replace(",", "-")
+
+
+def set_current_shard(shard):
+    """
+    Point the index and pickle files into the directory of an index shard,
+    ``<x4i3_db_dir>/shards/<shard_name>``. Call after set_current_dir.
+    """
+    global currentIndexFileName, currentErrorFileName
+    global currentCoupledFileName, currentMonitoredFileName
+    global currentReactionCountFileName
+
+    shard_dir = pathlib.Path(currentIndexFileName).parent / "shards" / shard_name(shard)
+    recreate_dir(shard_dir, force=force)
+
+    print("set_current_shard(): Index shard will be written to", shard_dir)
+    currentIndexFileName = shard_dir / indexFileName
+    currentErrorFileName = shard_dir / errorFileName
+    currentCoupledFileName = shard_dir / coupledFileName
+    currentMonitoredFileName = shard_dir / monitoredFileName
+    currentReactionCountFileName = shard_dir / reactionCountFileName
+
+    return shard_dir
+
+
 def getQuantity(quantList):
     """
     Most quantities are the 1st ones in the quantity list
@@ -0,0 +1,293 @@
+"""
+Columnar store of the numbers in the DATA and COMMON sections.
+
+Every DATA or COMMON section of a subentry is stored as a float64 array of
+(rows, columns), blanks are NaN, in a single packed file. A pickled index next
+to it maps (subent, section) to the offset and shape of the array and to the
+column headings and units, and every entry to its content hash. The packed
+file is memory mapped by ``DataColumnStore``, the arrays are read-only views
+of the map, nothing is parsed or copied on access.
+
+Writing the store only splits the subentries into sections and reads the
+DATA and COMMON sections with x4i3, the BIB sections are not parsed. The
+arrays of entries with an unchanged content hash are copied from the previous
+store. NumPy is only needed for the store, it is imported on use.
+"""
+import os
+import pathlib
+
+# Arrays start at multiples of this many bytes in the packed file
+_alignment = 64
+_dtype = "<f8"
+
+
+def iter_data_sections(subentry):
+    """
+    Yield the (tag, lines) of the DATA and COMMON sections of a raw subentry,
+    split like ``x4i3.exfor_subentry.X4SubEntry.chunkify``.
+    """
+    section = None
+    for line in subentry.split("\n"):
+        if section is not None:
+            section.append(line)
+            if line[0:3] == "END":
+                if tag in ("DATA", "COMMON"):
+                    yield tag, section
+                section = None
+        elif line[0:11].strip() in ("BIB", "DATA", "COMMON"):
+            tag = line[0:11].strip()
+            section = [line]
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def extract_data_columns(work_package):
+    """
+    Read the DATA and COMMON sections of the entries in a workpackage
+    (entrySource, [(name, previous hash)]). Returns a list of (accnum, hash,
+    sections, error) per entry. ``sections`` is None if the hash did not
+    change, else a list of (subent, tag, labels, units, array). ``error`` is
+    the message if a section could not be read, the other sections of the
+    entry are kept.
+    """
+    import numpy
+    import x4i3tools as x4t
+    from x4i3.exfor_section import X4DataSection
+    from x4i3.exfor_subentry import extractX4SubEntryIndex
+
+    entrySource, names = work_package
+    results = []
+    for name, previous_hash in names:
+        accnum = pathlib.PurePath(name).stem
+        fhash = x4t.content_hash(entrySource.read_bytes(name))
+        if fhash == previous_hash:
+            results.append((accnum, fhash, None, None))
+            continue
+        sections = []
+        error = None
+        for subentry in entrySource.x4entry(name, rawEntry=True):
+            subent = extractX4SubEntryIndex(subentry.split("\n"))
+            for tag, lines in iter_data_sections(subentry):
+                try:
+                    section = X4DataSection(tag, lines)
+                except Exception as err:
+                    error = "{0} {1}: {2}".format(subent, tag, err)
+                    continue
+                array = numpy.array(
+                    [[_as_float(value) for value in row] for row in section.data],
+                    dtype=_dtype,
+                ).reshape(len(section.data), section.numcols)
+                sections.append(
+                    (subent, tag, list(section.labels), list(section.units), array)
+                )
+        results.append((accnum, fhash, sections, error))
+    return results
+
+
+def write_data_store(entrySource, storeFileName):
+    """
+    Write the DATA and COMMON sections of all entries of ``entrySource`` to
+    the packed file ``storeFileName`` and its index, see DataColumnStore.
+    An existing store is updated: entries with the same content hash keep
+    their arrays, changed entries are read again and removed entries are
+    dropped. The new store replaces the old one when it is complete.
+    """
+    import pickle
+    from multiprocessing import Pool
+    from tqdm import tqdm
+    import x4i3tools as x4t
+
+    storeFileName = pathlib.Path(storeFileName)
+    indexFileName = x4t.store_index_file_name(storeFileName)
+    previous = None
+    if storeFileName.exists() and indexFileName.exists():
+        previous = DataColumnStore(storeFileName)
+    previous_hashes = previous.hashes if previous is not None else {}
+
+    names = sorted(entrySource.list_entries())
+    workpackages = [
+        (
+            entrySource,
+            [
+                (name, previous_hashes.get(pathlib.PurePath(name).stem))
+                for name in chunk
+            ],
+        )
+        for chunk in x4t.chunks(names, 50)
+    ]
+
+    entries = {}
+    sections = {}
+    errors = {}
+    offset = 0
+    nchanged = 0
+    tmpFileName = storeFileName.with_name(storeFileName.name + ".tmp")
+
+    def append(store, block):
+        nonlocal offset
+        padding = -offset % _alignment
+        store.write(b"\0" * padding)
+        offset += padding
+        store.write(block)
+        start, offset = offset, offset + len(block)
+        return start
+
+    print("Writing the DATA/COMMON column store", storeFileName)
+    with open(tmpFileName, mode="wb") as store, Pool(x4t.nthreads) as mpool:
+        for results in tqdm(
+            x4t.imap_bounded(
+                mpool, extract_data_columns, workpackages, ordered=False
+            ),
+            total=len(workpackages),
+        ):
+            for accnum, fhash, entry_sections, error in results:
+                if entry_sections is None:
+                    # Unchanged, copy the arrays from the previous store
+                    keys = previous.entries[accnum][1]
+                    for key in keys:
+                        _, shape, labels, units = previous.sections[key]
+                        start = append(store, previous.read_bytes(*key))
+                        sections[key] = (start, shape, labels, units)
+                    if accnum in previous.errors:
+                        errors[accnum] = previous.errors[accnum]
+                else:
+                    nchanged += 1
+                    keys = []
+                    for subent, tag, labels, units, array in entry_sections:
+                        start = append(store, array.tobytes())
+                        sections[(subent, tag)] = (start, array.shape, labels, units)
+                        keys.append((subent, tag))
+                    if error is not None:
+                        errors[accnum] = error
+                entries[accnum] = (fhash, keys)
+
+    with open(str(indexFileName) + ".tmp", mode="wb") as f:
+        pickle.dump(
+            {
+                "dtype": _dtype,
+                "entries": entries,
+                "sections": sections,
+                "errors": errors,
+            },
+            f,
+        )
+    if previous is not None:
+        previous.close()
+    os.replace(tmpFileName, storeFileName)
+    os.replace(str(indexFileName) + ".tmp", indexFileName)
+
+    print("Data store:")
+    print("\tEntries:", len(entries), "read:", nchanged)
+    print("\tSections:", len(sections))
+    print("\tBytes:", offset)
+    print("\tSections that could not be read:", len(errors))
+    return len(sections)
+
+
+class DataColumnStore:
+    """
+    Read-only access to a store written by write_data_store.
+
+    ``array(subent, "DATA")`` returns the (rows, columns) float64 array of a
+    section, ``columns(subent, "DATA")`` a dict of column heading to column.
+    Both are views of the memory mapped file. Like the entry sources, a store
+    can be handed to pool workers, every process maps the file on first use.
+    """
+
+    def __init__(self, storeFileName, indexFileName=None):
+        import x4i3tools as x4t
+
+        self.storeFileName = pathlib.Path(storeFileName).absolute()
+        if indexFileName is None:
+            indexFileName = x4t.store_index_file_name(storeFileName)
+        self.indexFileName = pathlib.Path(indexFileName).absolute()
+
+    def __repr__(self):
+        return "DataColumnStore({0})".format(self.storeFileName)
+
+    def _load(self):
+        import mmap
+        import pickle
+
+        with open(self.indexFileName, mode="rb") as f:
+            index = pickle.load(f)
+        blob = None
+        if os.path.getsize(self.storeFileName) > 0:
+            with open(self.storeFileName, mode="rb") as f:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return blob, index
+
+    def _open(self):
+        """The memory map and index of the store in this process."""
+        import x4i3tools as x4t
+
+        return x4t.process_handle(("data", self.storeFileName), self._load)
+
+    def close(self):
+        """Unmap the file in the current process."""
+        import x4i3tools as x4t
+
+        handle = x4t.forget_process_handle(("data", self.storeFileName))
+        if handle is not None and handle[0] is not None:
+            try:
+                handle[0].close()
+            except BufferError:
+                # Arrays handed out still refer to the map
+                pass
+
+    @property
+    def entries(self):
+        return self._open()[1]["entries"]
+
+    @property
+    def sections(self):
+        return self._open()[1]["sections"]
+
+    @property
+    def errors(self):
+        return self._open()[1]["errors"]
+
+    @property
+    def hashes(self):
+        return {accnum: entry[0] for accnum, entry in self.entries.items()}
+
+    def subentries(self):
+        return sorted({subent for subent, _ in self.sections})
+
+    def labels(self, subent, section="DATA"):
+        return self.sections[(subent, section)][2]
+
+    def units(self, subent, section="DATA"):
+        return self.sections[(subent, section)][3]
+
+    def read_bytes(self, subent, section="DATA"):
+        """The raw bytes of the array of a section."""
+        import numpy
+
+        blob, index = self._open()
+        offset, shape, _, _ = index["sections"][(subent, section)]
+        nbytes = shape[0] * shape[1] * numpy.dtype(index["dtype"]).itemsize
+        return blob[offset : offset + nbytes] if nbytes else b""
+
+    def array(self, subent, section="DATA"):
+        import numpy
+
+        blob, index = self._open()
+        offset, shape, _, _ = index["sections"][(subent, section)]
+        count = shape[0] * shape[1]
+        if count == 0:
+            return numpy.empty(shape, dtype=index["dtype"])
+        return numpy.frombuffer(
+            blob, dtype=index["dtype"], count=count, offset=offset
+        ).reshape(shape)
+
+    def columns(self, subent, section="DATA"):
+        array = self.array(subent, section)
+        return {
+            label: array[:, i] for i, label in enumerate(self.labels(subent, section))
+        }
@@ -14,6 +14,31 @@ def getSimpleReaction(complicatedReaction):
     return SimpleReaction(proj, targ, prod, rtext, quant, simpleRxn)
 
 
+# BIB keywords of the full-text index with a column of their own, the other
+# free text goes to the freetext column. The structured fields are in theworks
+bib_text_columns = ["TITLE", "INSTITUTE", "FACILITY", "METHOD"]
+bib_text_skipped = ["AUTHOR", "REACTION", "MONITOR"]
+
+
+def getBibText(accnum, snum, bib):
+    """
+    The row of the full-text index for the BIB section of a subentry:
+    (entry, subent, title, institute, facility, method, freetext).
+    """
+    columns = {key: [] for key in bib_text_columns + ["FREETEXT"]}
+    for key in bib.keys():
+        if key in bib_text_skipped:
+            continue
+        try:
+            text = str(bib[key])
+        except Exception:
+            continue
+        columns[key if key in columns else "FREETEXT"].append(text)
+    return (accnum, snum) + tuple(
+        " ".join(columns[key]) for key in bib_text_columns + ["FREETEXT"]
+    )
+
+
 def processEntry(
     entryFileName,
     sqlTransactions,
@@ -21,17 +46,28 @@ def processEntry(
     monitoredReactionEntries,
     reactionCount,
     dbPath,
+    bibText=None,
 ):
     """
     Computes the rows for a single entry and puts it in the database
+
+    ``dbPath`` is either the db directory or an entry source from
+    ``x4i3tools.entry_sources`` that contains ``entryFileName``. If a
+    ``bibText`` list is given, the rows of the full-text index for the BIB
+    sections of the entry are appended to it (see getBibText).
+
+    Returns the publication year of the entry (of the first REFERENCE in its
+    first BIB section), or None if it is not known.
     """
+    import pathlib
     import x4i3tools as x4t
-    from x4i3 import exfor_entry, exfor_reactions
+    from x4i3 import exfor_reactions
+    from x4i3tools.entry_sources import as_entry_source
 
     if x4t.verbose:
-        print("        ", entryFileName.name, end=" ")
+        print("        ", pathlib.PurePath(entryFileName).name, end=" ")
 
-    this_entry = exfor_entry.x4EntryFactory(entryFileName.stem, customDBPath=dbPath)
+    this_entry = as_entry_source(dbPath).x4entry(entryFileName)
 
     doc_bib = this_entry[1]["BIB"]
     try:
@@ -47,6 +83,18 @@ def processEntry(
         auth = doc_bib["AUTHOR"].author_family_names
     if "INSTITUTE" in doc_bib:
         inst = doc_bib["INSTITUTE"]
+    year = None
+    if "REFERENCE" in doc_bib:
+        try:
+            year = int(doc_bib["REFERENCE"].pubyear)
+        except (AttributeError, TypeError, ValueError):
+            pass
+    if bibText is not None:
+        for snum in this_entry.sortedKeys():
+            if "BIB" in this_entry[snum]:
+                bibText.append(
+                    getBibText(this_entry.accnum, snum, this_entry[snum]["BIB"])
+                )
     if x4t.verbose:
         print("        ", "Num. authors:", len(auth))
         print("        ", "Num. institutes:", len(inst))
@@ -195,3 +243,5 @@ def processEntry(
             print("           ", "Num. reactions:", nrxns)
             print("           ", "Num. monitors:", nmons)
             print()
+
+    return year
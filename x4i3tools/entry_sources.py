@@ -0,0 +1,220 @@
+"""
+Sources of raw EXFOR entries for the index generators.
+
+An entry source lists the entries it contains with ``list_entries()``, tells
+the (stored) size of one of them with ``entry_size(name)`` and constructs the
+``X4Entry`` for it with ``x4entry(name)``, which takes the same optional
+arguments as ``x4i3.exfor_entry.x4EntryFactory``. ``read_bytes(name)``
+returns the raw content and ``entry_stamp(name)`` a cheap ``(mtime, size)``
+stamp used to detect modified entries (mtime is None if the source has none).
+Sources are handed to the pool workers as part of the workpackages, so they
+must be picklable and must not carry open file handles across processes.
+"""
+import os
+import pathlib
+
+
+def x4_entry_from_lines(lines, subentsList=None, rawEntry=False):
+    """
+    Construct an X4Entry from the lines of an .x4 file. Splits the entry into
+    subentries in the same way as ``x4i3.exfor_entry.x4EntryFactory``, the
+    rawEntry=True flag returns just the unparsed list of SUBENTs.
+    """
+    from x4i3 import exfor_entry
+
+    result = []
+    subent = ""
+    for line in lines:
+        if (
+            line.startswith("ENTRY")
+            or line.startswith("ENDENTRY")
+            or line.startswith("NOSUBENT")
+        ):
+            pass
+        elif line.startswith("SUBENT"):
+            subent = line
+        else:
+            subent += line
+        if line.startswith("ENDSUBENT"):
+            if subentsList is None or subent[14:22].strip() in subentsList:
+                result.append(subent)
+            subent = ""
+    if rawEntry:
+        return result
+    return exfor_entry.X4Entry(result)
+
+
+def as_entry_source(source_or_path):
+    """Wrap a db directory (as used by x4EntryFactory) into an entry source."""
+    if hasattr(source_or_path, "x4entry"):
+        return source_or_path
+    return DirectoryEntrySource(source_or_path)
+
+
+class DirectoryEntrySource:
+    """Entries unpacked to disk as ``<dbPath>/NNN/NNNNN.x4``."""
+
+    def __init__(self, dbPath):
+        self.dbPath = pathlib.Path(dbPath)
+
+    def __repr__(self):
+        return "DirectoryEntrySource({0})".format(self.dbPath)
+
+    def list_entries(self):
+        return list(self.dbPath.glob("**/*.x4"))
+
+    def entry_size(self, name):
+        return os.path.getsize(self.dbPath / name)
+
+    def _path(self, name):
+        enum = pathlib.PurePath(name).stem
+        return self.dbPath / enum[:3] / (enum + ".x4")
+
+    def entry_stamp(self, name):
+        stat = os.stat(self._path(name))
+        return stat.st_mtime, stat.st_size
+
+    def read_bytes(self, name):
+        return self._path(name).read_bytes()
+
+    def read_lines(self, name):
+        with open(self._path(name), mode="r", encoding="latin1") as f:
+            return f.readlines()
+
+    def x4entry(self, name, subentsList=None, rawEntry=False):
+        from x4i3 import exfor_entry
+
+        return exfor_entry.x4EntryFactory(
+            pathlib.PurePath(name).stem,
+            subentsList=subentsList,
+            rawEntry=rawEntry,
+            customDBPath=self.dbPath,
+        )
+
+
+class ZipEntrySource:
+    """
+    Entries read directly from the ``*.x4`` members of an X4 master zip file.
+
+    Every process opens its own handle to the zip file on first use.
+    """
+
+    def __init__(self, zipFileName):
+        self.zipFileName = pathlib.Path(zipFileName).absolute()
+
+    def __repr__(self):
+        return "ZipEntrySource({0})".format(self.zipFileName)
+
+    @property
+    def zip(self):
+        import zipfile
+        import x4i3tools as x4t
+
+        return x4t.process_handle(
+            ("zip", self.zipFileName),
+            lambda: zipfile.ZipFile(self.zipFileName, "r"),
+        )
+
+    def list_entries(self):
+        return [name for name in self.zip.namelist() if name.endswith(".x4")]
+
+    def entry_size(self, name):
+        return self.zip.getinfo(name).file_size
+
+    def entry_stamp(self, name):
+        import time
+
+        info = self.zip.getinfo(name)
+        return time.mktime(info.date_time + (0, 0, -1)), info.file_size
+
+    def read_bytes(self, name):
+        return self.zip.read(name)
+
+    def read_lines(self, name):
+        import io
+
+        with io.TextIOWrapper(self.zip.open(name), encoding="latin1") as f:
+            return f.readlines()
+
+    def x4entry(self, name, subentsList=None, rawEntry=False):
+        return x4_entry_from_lines(self.read_lines(name), subentsList, rawEntry)
+
+
+class PackedEntrySource:
+    """
+    Entries concatenated into a single packed file (see
+    ``x4i3tools.fileops.write_packed_store``) with a pickled
+    ``{accnum: (offset, length)}`` index next to it.
+
+    The packed file is memory mapped, every entry is a single slice of the map.
+    In compressed stores every entry is a separate zlib stream, which is
+    decompressed on access.
+    """
+
+    def __init__(self, storeFileName, indexFileName=None):
+        import x4i3tools as x4t
+
+        self.storeFileName = pathlib.Path(storeFileName).absolute()
+        if indexFileName is None:
+            indexFileName = x4t.store_index_file_name(storeFileName)
+        self.indexFileName = pathlib.Path(indexFileName).absolute()
+
+    def __repr__(self):
+        return "PackedEntrySource({0})".format(self.storeFileName)
+
+    def _load(self):
+        import mmap
+        import pickle
+
+        with open(self.indexFileName, mode="rb") as f:
+            index = pickle.load(f)
+        with open(self.storeFileName, mode="rb") as f:
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return blob, index
+
+    def _open(self):
+        """The memory map and offset index of the store in this process."""
+        import x4i3tools as x4t
+
+        return x4t.process_handle(("packed", self.storeFileName), self._load)
+
+    @property
+    def index(self):
+        return self._open()[1]["entries"]
+
+    @property
+    def compression(self):
+        return self._open()[1]["compression"]
+
+    def list_entries(self):
+        return sorted(self.index)
+
+    def entry_size(self, name):
+        return self.index[pathlib.PurePath(name).stem][1]
+
+    def read_entry(self, accnum):
+        """Return the raw text of an entry, ENTRY to ENDENTRY."""
+        import zlib
+
+        blob = self._open()[0]
+        offset, length = self.index[accnum]
+        data = blob[offset : offset + length]
+        if self.compression == "zlib":
+            data = zlib.decompress(data)
+        return data.decode("latin1")
+
+    def entry_stamp(self, name):
+        # Offsets change whenever the store is rewritten, compare the content
+        return None, self.entry_size(name)
+
+    def read_bytes(self, name):
+        return self.read_entry(pathlib.PurePath(name).stem).encode("latin1")
+
+    def read_lines(self, name):
+        import io
+
+        # StringIO splits on newlines only, like reading the .x4 file would
+        return io.StringIO(self.read_entry(pathlib.PurePath(name).stem)).readlines()
+
+    def x4entry(self, name, subentsList=None, rawEntry=False):
+        return x4_entry_from_lines(self.read_lines(name), subentsList, rawEntry)
@@ -1,33 +1,332 @@
 import os
 
 
+def iter_bck_entries(stream):
+    """
+    Yield the ENTRY ... ENDENTRY blocks of an EXFOR backup (.bck) file, one at
+    a time, as lists of lines.
+
+    Splits like ``x4i3.exfor_utilities.chunkifyX4Request`` but reads ``stream``
+    incrementally, so that never more than one entry is held in memory.
+    """
+    inEntry = False
+    entry = []
+    for line in stream:
+        if inEntry:
+            entry.append(line)
+            if line[0:11].strip() == "ENDENTRY":
+                yield entry
+                inEntry = False
+        elif line[0:11].strip() == "ENTRY":
+            inEntry = True
+            entry = [line]
+
+
+def bck_member_name(zip_ref):
+    """Name of the .bck member of an EXFOR master zip file."""
+    members = [name for name in zip_ref.namelist() if name.endswith(".bck")]
+    if not members:
+        raise IOError("No .bck file found in", zip_ref.filename)
+    return members[0]
+
+
+def open_bck_member(zip_ref):
+    """Open the .bck member of an EXFOR master zip file as a text stream."""
+    import io
+
+    # latin1 maps every byte to one character, entries are written back unaltered
+    return io.TextIOWrapper(zip_ref.open(bck_member_name(zip_ref)), encoding="latin1")
+
+
+def copy_bck_entry_ranges(zip_ref, bckFileName):
+    """
+    Copy the .bck member of an EXFOR master zip file to ``bckFileName`` and
+    yield ``(accnum, offset, length)`` for every ENTRY ... ENDENTRY block in the
+    copy, as soon as the block has been written.
+    """
+    offset = 0
+    start = None
+    with zip_ref.open(bck_member_name(zip_ref)) as src, open(
+        bckFileName, mode="wb"
+    ) as dst:
+        for line in src:
+            dst.write(line)
+            if start is None:
+                if line[0:11].strip() == b"ENTRY":
+                    start = offset
+                    entryNum = line[17:22].decode("latin1")
+            elif line[0:11].strip() == b"ENDENTRY":
+                # make the block visible to the workers before handing it out
+                dst.flush()
+                yield entryNum, start, offset + len(line) - start
+                start = None
+            offset += len(line)
+
+
+def write_if_changed(fileName, data, oldHash):
+    """
+    Write ``data`` to ``fileName`` unless the file exists and its content hash
+    is ``oldHash``. Returns the new content hash and whether it was written.
+    """
+    import x4i3tools as x4t
+
+    newHash = x4t.content_hash(data)
+    if newHash == oldHash and os.path.exists(fileName):
+        return newHash, False
+
+    os.makedirs(os.path.dirname(fileName), exist_ok=True)
+    with open(fileName, mode="wb") as f:
+        f.write(data)
+    return newHash, True
+
+
 def write_entries_to_file(args):
-    dbPath, entries = args
+    """
+    Write the entries found at the given byte ranges of a .bck file to
+    ``<dbPath>/NNN/NNNNN.x4``. Only the ranges are passed between processes,
+    every worker reads the entry text itself. Entries whose content hash
+    matches the one of the previous unpack are not rewritten.
+    """
+    dbPath, bckFileName, ranges = args
 
-    nfiles_written = 0
-    for entry in entries:
-        for line in entry:
-            if "ENTRY" in line:
-                entryNum = line[17:22]
-                break
-        newX4Path = os.path.join(dbPath, entryNum[0:3])
+    results = []
+    with open(bckFileName, mode="rb") as bck:
+        for entryNum, offset, length, oldHash in ranges:
+            bck.seek(offset)
+            entry = bck.read(length)
+            newX4File = os.path.join(dbPath, entryNum[0:3], entryNum + ".x4")
+            results.append((entryNum,) + write_if_changed(newX4File, entry, oldHash))
+
+    return results
+
+
+def zip_member_path(targetDir, member):
+    """
+    Path of a zip member extracted to ``targetDir``. Like
+    ``ZipFile._extract_member``, drive letters and empty, ``.`` and ``..``
+    parts of the name are dropped, so that no member is written outside of
+    ``targetDir``.
+    """
+    arcname = member.replace("/", os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [
+        part
+        for part in arcname.split(os.path.sep)
+        if part not in ("", os.path.curdir, os.path.pardir)
+    ]
+    return os.path.join(targetDir, *parts)
 
-        try:
-            os.makedirs(newX4Path)
-        except FileExistsError:
-            pass
 
-        newX4File = entryNum + ".x4"
-        open(os.path.join(newX4Path, newX4File), mode="w").writelines("".join(entry))
-        nfiles_written += 1
+def extract_zip_members(args):
+    """
+    Extract a range of members from a zip file, with a per-process handle.
+    Members ``(name, oldHash)`` whose content hash matches the one of the
+    previous unpack are not rewritten.
+    """
+    import pathlib
+    from x4i3tools.entry_sources import ZipEntrySource
 
-    return nfiles_written
+    zipFileName, targetDir, members = args
 
+    zip_ref = ZipEntrySource(zipFileName).zip
+    results = []
+    for member, oldHash in members:
+        if not member.endswith(".x4"):
+            zip_ref.extract(member, targetDir)
+            continue
+        newX4File = zip_member_path(targetDir, member)
+        results.append(
+            (pathlib.PurePosixPath(member).stem,)
+            + write_if_changed(newX4File, zip_ref.read(member), oldHash)
+        )
+
+    return results
+
+
+def load_previous_manifest(previousDir=None):
+    """
+    The ``{accnum: content hash}`` manifest of the tree at ``currentDBPath``.
+
+    If ``previousDir`` (the unpack directory of an earlier master) is given,
+    its tree is moved to ``currentDBPath`` first, so that unpacking the new
+    master only has to write the differences.
+    """
+    import json
+    import shutil
+    import pathlib
+    import x4i3tools as x4t
+
+    manifestFileName = x4t.currentManifestFileName
+    if previousDir is not None:
+        manifestFileName = pathlib.Path(previousDir) / x4t.manifestFileName
+    if not os.path.exists(manifestFileName):
+        if previousDir is not None:
+            raise IOError("No unpack manifest found in", previousDir)
+        return {}
+
+    with open(manifestFileName, mode="r") as f:
+        manifest = json.load(f)
+
+    if previousDir is not None:
+        if os.path.exists(x4t.currentDBPath):
+            raise IOError(
+                "Can not move the previous unpack to", x4t.currentDBPath, "it exists."
+            )
+        print("Moving", manifest["dbPath"], "to", x4t.currentDBPath)
+        shutil.move(manifest["dbPath"], x4t.currentDBPath)
+    elif not os.path.exists(x4t.currentDBPath):
+        return {}
+
+    return manifest["entries"]
+
+
+def move_previous_index(previousDir):
+    """
+    Move the index and pickled maps built for the tree of an earlier unpack
+    directory to the current database, to update them incrementally.
+    """
+    import json
+    import shutil
+    import pathlib
+    import x4i3tools as x4t
+
+    manifestFileName = pathlib.Path(previousDir) / x4t.manifestFileName
+    if manifestFileName.exists():
+        with open(manifestFileName, mode="r") as f:
+            previousDBDir = pathlib.Path(json.load(f)["dbPath"]).parent
+    else:
+        # Indexed straight from the master zip file, nothing was unpacked
+        indexes = sorted(
+            pathlib.Path(previousDir).glob(
+                "*/" + pathlib.Path(x4t.currentIndexFileName).name
+            )
+        )
+        if len(indexes) != 1:
+            raise IOError("No index found in", previousDir)
+        previousDBDir = indexes[0].parent
+    for file_name in [
+        x4t.currentIndexFileName,
+        x4t.currentErrorFileName,
+        x4t.currentCoupledFileName,
+        x4t.currentMonitoredFileName,
+        x4t.currentReactionCountFileName,
+    ]:
+        previous = previousDBDir / pathlib.Path(file_name).name
+        if not previous.exists():
+            raise IOError("No index found at", previous)
+        if os.path.exists(file_name) and not x4t.force:
+            raise IOError(
+                "Can not overwrite file", file_name, "Consider using -f (force) flag."
+            )
+        print("Moving", previous, "to", file_name)
+        shutil.move(previous, file_name)
 
-def unpackEXFORMaster(master_fname):
-    """Unpack an EXFOR master file"""
+
+def write_manifest(master_fname, manifest, oldManifest):
+    """
+    Save the manifest of the unpacked tree and the machine-readable list of
+    entries added, changed or removed w.r.t. ``oldManifest``. Entries that
+    are not in the new master anymore are deleted from the tree.
+    """
+    import json
+    import x4i3tools as x4t
+
+    changes = {
+        "master": str(master_fname),
+        "added": sorted(set(manifest) - set(oldManifest)),
+        "changed": sorted(
+            accnum
+            for accnum in manifest
+            if accnum in oldManifest and manifest[accnum] != oldManifest[accnum]
+        ),
+        "removed": sorted(set(oldManifest) - set(manifest)),
+    }
+    for accnum in changes["removed"]:
+        oldX4File = os.path.join(x4t.currentDBPath, accnum[0:3], accnum + ".x4")
+        if os.path.exists(oldX4File):
+            os.remove(oldX4File)
+
+    with open(x4t.currentManifestFileName, mode="w") as f:
+        json.dump(
+            {"dbPath": str(x4t.currentDBPath), "entries": manifest},
+            f,
+            indent=0,
+            sort_keys=True,
+        )
+    with open(x4t.currentChangesFileName, mode="w") as f:
+        json.dump(changes, f, indent=1)
+
+    print(
+        "Entries added: {0}, changed: {1}, removed: {2}".format(
+            len(changes["added"]), len(changes["changed"]), len(changes["removed"])
+        )
+    )
+    return changes
+
+
+def write_packed_store(entries, storeFileName, compress=False):
+    """
+    Concatenate entries (lists of lines, ENTRY to ENDENTRY) into a single
+    packed file and pickle the ``{accnum: (offset, length)}`` index next to
+    it. Read back with ``x4i3tools.entry_sources.PackedEntrySource``.
+
+    With ``compress=True`` every entry is stored as a separate zlib stream, so
+    that single entries can still be read without decompressing the others.
+    """
+    import pickle
+    import zlib
+    import x4i3tools as x4t
+
+    index = {}
+    offset = 0
+    nbytes = 0
+    with open(storeFileName, mode="wb") as store:
+        for entry in entries:
+            entryNum = entry[0][17:22]
+            data = "".join(entry).encode("latin1")
+            nbytes += len(data)
+            if compress:
+                data = zlib.compress(data, 9)
+            store.write(data)
+            index[entryNum] = (offset, len(data))
+            offset += len(data)
+
+    with open(x4t.store_index_file_name(storeFileName), mode="wb") as f:
+        pickle.dump(
+            {"compression": "zlib" if compress else None, "entries": index}, f
+        )
+
+    if compress:
+        print(
+            "Compressed {0} bytes to {1} bytes ({2:.1f}%)".format(
+                nbytes, offset, 100.0 * offset / max(nbytes, 1)
+            )
+        )
+    return len(index)
+
+
+def unpackEXFORMaster(master_fname, packed=False, previousDir=None, compress=False):
+    """
+    Unpack an EXFOR master file.
+
+    The .bck file is streamed out of the zip file and split into entries on the
+    fly. The workers only receive byte ranges into the copy of the .bck file
+    in the unpack directory and read the entries themselves. Only a bounded
+    number of workpackages is in flight at any time, so the memory use does
+    not depend on the size of the master file.
+
+    With ``packed=True`` the entries are written to the packed store
+    ``currentPackedStoreFileName`` instead of the db/NNN/ tree, with
+    ``compress=True`` every entry in it is zlib compressed.
+
+    Only entries that differ from the previous unpack into the same directory,
+    or into ``previousDir`` (see ``load_previous_manifest``), are written. The
+    differences are listed in ``currentChangesFileName``.
+    """
+    import pathlib
     import zipfile
-    import x4i3.exfor_utilities
     import x4i3tools as x4t
     from tqdm import tqdm
     from multiprocessing import Pool
@@ -36,39 +335,102 @@ def unpackEXFORMaster(master_fname):
 
     if x4t.verbose:
         print("Unpacking master file: ", master_fname)
-    with zipfile.ZipFile(master_fname, "r") as zip_ref:
-        zip_ref.extractall(unpackedDir)
 
     nfiles_written = 0
-    # repackage the file
-    backupFile = list(unpackedDir.glob("*.bck"))[0]
-    theLines = open(backupFile, mode="r").readlines()
-    entries = x4i3.exfor_utilities.chunkifyX4Request(theLines)
-    workpackages = [(x4t.currentDBPath, entries) for entries in x4t.chunks(entries, 30)]
-    with Pool(x4t.nthreads) as mpool:
-        processed = list(
-            tqdm(
-                mpool.imap(write_entries_to_file, workpackages), total=len(workpackages)
+    with zipfile.ZipFile(master_fname, "r") as zip_ref:
+        if packed:
+            with open_bck_member(zip_ref) as backup:
+                nfiles_written = write_packed_store(
+                    tqdm(iter_bck_entries(backup)),
+                    x4t.currentPackedStoreFileName,
+                    compress,
+                )
+            print("In total", nfiles_written, "have been packed.")
+            return
+
+        oldManifest = load_previous_manifest(previousDir)
+        manifest = {}
+        bckFileName = unpackedDir / pathlib.PurePath(bck_member_name(zip_ref)).name
+        ranges = (
+            (entryNum, offset, length, oldManifest.get(entryNum))
+            for entryNum, offset, length in copy_bck_entry_ranges(
+                zip_ref, bckFileName
             )
         )
-    nfiles_written = sum(processed)
+        workpackages = (
+            (x4t.currentDBPath, bckFileName, chunk) for chunk in x4t.chunks(ranges, 30)
+        )
+        with Pool(x4t.nthreads) as mpool:
+            for results in tqdm(
+                x4t.imap_bounded(mpool, write_entries_to_file, workpackages)
+            ):
+                for entryNum, newHash, written in results:
+                    manifest[entryNum] = newHash
+                    nfiles_written += written
 
     print("In total", nfiles_written, "have been extracted.")
+    write_manifest(master_fname, manifest, oldManifest)
+
 
-    # cleanup
-    # shutil.rmtree(unpackedDir)
+def unpackX4Master(master_fname, packed=False, previousDir=None, compress=False):
+    """
+    Unpack an X4 master file to ``unpack_<stem>/X4all``.
 
+    This step is optional. The index can be built directly from the zip file
+    through ``x4i3tools.entry_sources.ZipEntrySource``.
 
-def unpackX4Master(master_fname):
-    """Unpack an X4 master file."""
+    With ``packed=True`` the entries are written to the packed store
+    ``currentPackedStoreFileName`` instead of the X4all tree, with
+    ``compress=True`` every entry in it is zlib compressed.
+
+    Only entries that differ from the previous unpack into the same directory,
+    or into ``previousDir`` (see ``load_previous_manifest``), are written. The
+    differences are listed in ``currentChangesFileName``.
+    """
+    import pathlib
     import zipfile
     import x4i3tools
+    from tqdm import tqdm
+    from multiprocessing import Pool
+    from x4i3tools.entry_sources import ZipEntrySource
 
     unpackedDir = x4i3tools.set_current_dir(master_fname)[0]
 
     if x4i3tools.verbose:
         print("Unpacking master file: ", master_fname)
+
+    if packed:
+        source = ZipEntrySource(master_fname)
+        nfiles_written = write_packed_store(
+            (source.read_lines(name) for name in tqdm(source.list_entries())),
+            x4i3tools.currentPackedStoreFileName,
+            compress,
+        )
+        print("In total", nfiles_written, "have been packed.")
+        return
+
+    x4i3tools.currentDBPath = unpackedDir / "X4all"
+    oldManifest = load_previous_manifest(previousDir)
+    manifest = {}
+
+    # Members are decompressed in parallel, each worker opens its own handle
     with zipfile.ZipFile(master_fname, "r") as zip_ref:
-        zip_ref.extractall(unpackedDir)
+        members = [
+            (name, oldManifest.get(pathlib.PurePosixPath(name).stem))
+            for name in zip_ref.namelist()
+        ]
+    workpackages = [
+        (master_fname, unpackedDir, chunk) for chunk in x4i3tools.chunks(members, 200)
+    ]
+    nfiles_written = 0
+    with Pool(x4i3tools.nthreads) as mpool:
+        for results in tqdm(
+            mpool.imap_unordered(extract_zip_members, workpackages),
+            total=len(workpackages),
+        ):
+            for entryNum, newHash, written in results:
+                manifest[entryNum] = newHash
+                nfiles_written += written
 
-    x4i3tools.currentDBPath = os.path.join(unpackedDir, "X4all")
+    print("In total", nfiles_written, "have been extracted.")
+    write_manifest(master_fname, manifest, oldManifest)
@@ -1,29 +1,314 @@
 import os
+import time
+from collections import namedtuple
 from posixpath import abspath
 
+# The (coupled, monitored, reactionCount, buggy) maps accumulated by a pool
+# worker across its workpackages, the barrier used to drain them, the
+# time the worker spent on workpackages and the sqlite file it writes its rows
+# to, if any
+_worker_maps = None
+_worker_barrier = None
+_worker_stats = None
+_worker_db = None
 
-def process_file_package(work_package):
+# Results of parse_entry, cached as plain tuples by parse_cache
+ParsedEntry = namedtuple(
+    "ParsedEntry",
+    "sql_transactions coupled monitored reactionCount error bibText year",
+)
+# State of an indexed entry, see entry_record
+EntryRecord = namedtuple(
+    "EntryRecord", "accnum name hash mtime size reactionCount bibText year"
+)
+# Results of process_file_package
+PackageResult = namedtuple(
+    "PackageResult",
+    "coupled monitored reactionCount sql_transactions buggy entry_records "
+    + "cache_misses checkpoint rss",
+)
+
+
+def warm_up_parsers(entrySource=None, sample=None):
+    """
+    Import the x4i3 modules used by processEntry, which build the grammars and
+    load the dictionaries at import time, and parse the ``sample`` entry of
+    ``entrySource`` to initialise whatever is set up on first use.
+    """
+    import pyparsing  # noqa: F401
+    from x4i3 import exfor_entry, exfor_exceptions, exfor_reactions  # noqa: F401
+    from x4i3tools import entry_generators  # noqa: F401
+
+    if sample is not None:
+        try:
+            parse_entry(entrySource, sample)
+        except Exception:
+            pass
+
+
+def worker_index_file_name(indexFileName, pid):
+    """The sqlite file a pool worker writes its rows to, next to the index."""
+    return "{0}.worker-{1}".format(indexFileName, pid)
+
+
+def init_index_worker(barrier, entrySource=None, sample=None, indexFileName=None):
+    """
+    Pool initializer: warm up the parsers and reduce the maps inside the
+    worker, see drain_worker_maps. With ``indexFileName`` the worker writes
+    its rows to its own sqlite file next to it (worker_index_file_name)
+    instead of returning them to the parent.
+    """
+    global _worker_maps, _worker_barrier, _worker_stats, _worker_db
+
+    start = time.time()
+    warm_up_parsers(entrySource, sample)
+    _worker_maps = ({}, {}, {}, {})
+    _worker_barrier = barrier
+    _worker_stats = {
+        "pid": os.getpid(),
+        "busy": 0.0,
+        "workpackages": 0,
+        "end": None,
+        "warmup": time.time() - start,
+    }
+    if indexFileName is not None:
+        import sqlite3
+
+        _worker_db = sqlite3.connect(  # pylint: disable=no-member
+            worker_index_file_name(indexFileName, os.getpid())
+        )
+        _worker_db.isolation_level = None
+        _worker_db.execute("pragma journal_mode = wal")
+        _worker_db.execute("pragma synchronous = off")
+        create_index_tables(_worker_db.cursor(), normalized=False)
+        _worker_db.execute("""create table if not exists checkpoint (maps blob)""")
+
+
+def drain_worker_maps(_):
+    """
+    Return the maps and the busy time statistics accumulated by this worker.
+    Dispatch exactly one of these tasks per worker; the barrier keeps a worker
+    from taking a second one.
+    """
+    global _worker_maps, _worker_db
+
+    maps = _worker_maps
+    _worker_maps = ({}, {}, {}, {})
+    if _worker_db is not None:
+        _worker_db.close()
+        _worker_db = None
+    _worker_barrier.wait()
+    return maps, _worker_stats
+
+
+def schedule_workpackages(file_list, sizes, nthreads, max_entries=50):
+    """
+    Split the entries into workpackages by size (guided self-scheduling).
+
+    The largest entries are dispatched first, and every workpackage gets about
+    ``1 / (2 * nthreads)`` of the bytes still to be scheduled, up to
+    ``max_entries`` entries. The workpackages thus shrink towards the end of
+    the build, and since idle workers take the next workpackage from the
+    shared queue of the pool, the last ones are spread over all workers
+    instead of a few large entries becoming stragglers.
+    """
+    order = sorted(range(len(file_list)), key=lambda i: sizes[i], reverse=True)
+    remaining = sum(sizes)
+    workpackages = []
+    chunk = []
+    chunk_bytes = 0
+    for i in order:
+        chunk.append(file_list[i])
+        chunk_bytes += sizes[i]
+        if chunk_bytes >= remaining / (2 * nthreads) or len(chunk) >= max_entries:
+            workpackages.append(chunk)
+            remaining -= chunk_bytes
+            chunk = []
+            chunk_bytes = 0
+    if chunk:
+        workpackages.append(chunk)
+    return workpackages
+
+
+def select_shard(file_list, sizes, shard):
+    """
+    The entries of an index shard. ``shard`` is either a comma separated list
+    of 3-digit directories (e.g. "128,E07") or "K/N", the K-th of N shards
+    (counting from 0). The directories are assigned to the N shards by size,
+    largest first to the smallest shard, which is the same on every host
+    given the same entries.
+    """
+    import pathlib
+
+    def directory(f):
+        return pathlib.PurePath(f).stem[:3]
+
+    if "/" not in shard:
+        selected = set(shard.split(","))
+    else:
+        k, n = [int(x) for x in shard.split("/")]
+        if not 0 <= k < n:
+            raise ValueError("Shard {0} not in 0/{1}..{2}/{1}".format(shard, n, n - 1))
+        dir_sizes = {}
+        for f, size in zip(file_list, sizes):
+            dir_sizes[directory(f)] = dir_sizes.get(directory(f), 0) + size
+        shard_sizes = [0] * n
+        selected = set()
+        for d in sorted(dir_sizes, key=lambda d: (-dir_sizes[d], d)):
+            i = shard_sizes.index(min(shard_sizes))
+            shard_sizes[i] += dir_sizes[d]
+            if i == k:
+                selected.add(d)
+    return [f for f in file_list if directory(f) in selected]
+
+
+def report_worker_stats(worker_stats, start):
+    """Print the busy and idle time of the pool workers since ``start``."""
+    import x4i3tools as x4t
+
+    end = max(stats["end"] or start for stats in worker_stats)
+    busy = sum(stats["busy"] for stats in worker_stats)
+    warmup = [stats["warmup"] for stats in worker_stats]
+    print(
+        "Worker warmup: {0:.3f} s on average, at most {1:.3f} s".format(
+            sum(warmup) / len(warmup), max(warmup)
+        )
+    )
+    print(
+        "Worker utilisation: {0:.1f}% busy over {1:.1f} s, ".format(
+            100.0 * busy / max(len(worker_stats) * (end - start), 1e-9), end - start
+        )
+        + "last workpackages finished within {0:.1f} s".format(
+            end - min(stats["end"] or start for stats in worker_stats)
+        )
+    )
+    if x4t.verbose:
+        for stats in sorted(worker_stats, key=lambda stats: stats["pid"]):
+            print(
+                "\tWorker {0}: {1} workpackages, warmup {2:.3f} s, busy {3:.1f} s, "
+                "idle {4:.1f} s".format(
+                    stats["pid"],
+                    stats["workpackages"],
+                    stats["warmup"],
+                    stats["busy"],
+                    end - start - stats["busy"],
+                )
+            )
+
+
+def merge_index_maps(maps, other):
+    """
+    Reduce two (coupled, monitored, reactionCount, buggy) tuples into the
+    first one. Reaction counts are summed up, the other maps are united.
+    """
+    coupledReactionEntries, monitoredReactionEntries, reactionCount, buggyEntries = maps
+    (
+        other_coupledReactionEntries,
+        other_monitoredReactionEntries,
+        other_reactionCount,
+        other_buggyEntries,
+    ) = other
+
+    coupledReactionEntries.update(other_coupledReactionEntries)
+    monitoredReactionEntries.update(other_monitoredReactionEntries)
+    for rxn, count in other_reactionCount.items():
+        reactionCount[rxn] = reactionCount.get(rxn, 0) + count
+    buggyEntries.update(other_buggyEntries)
+    return maps
+
+
+def tree_reduce(func, items):
+    """Reduce items pairwise, in log2(len(items)) rounds."""
+    items = list(items)
+    while len(items) > 1:
+        items = [
+            func(items[i], items[i + 1]) if i + 1 < len(items) else items[i]
+            for i in range(0, len(items), 2)
+        ]
+    return items[0]
+
+
+def entry_record(entrySource, name, fhash, reactionCount, bibText=(), year=None):
+    """
+    The state of an indexed entry as stored in the ``entrystate``,
+    ``entryreactions``, ``bibtext`` and ``entryyears`` tables, an EntryRecord.
+    The name is stored relative to ``currentDBPath``, the index does not
+    depend on where it was built.
+    """
+    import pathlib
+    import x4i3tools as x4t
+
+    mtime, size = entrySource.entry_stamp(name)
+    relName = pathlib.PurePath(name)
+    if x4t.currentDBPath is not None and relName.is_absolute():
+        try:
+            relName = relName.relative_to(x4t.currentDBPath)
+        except ValueError:
+            pass
+    return EntryRecord(
+        pathlib.PurePath(name).stem,
+        relName.as_posix(),
+        fhash,
+        mtime,
+        size,
+        reactionCount,
+        list(bibText),
+        year,
+    )
+
+
+class EntryTimeoutError(TimeoutError):
+    """Parsing an entry took longer than its time budget."""
+
+
+def _raise_entry_timeout(signum, frame):
+    raise EntryTimeoutError("Parsing took longer than the time budget of the entry")
+
+
+def _set_entry_alarm(timeout, interval=0.0):
+    import signal
+
+    signal.setitimer(signal.ITIMER_REAL, timeout, interval)
+
+
+def parse_entry(entrySource, name, timeout=None):
+    """
+    Run processEntry on a single entry. Returns its ParsedEntry, where error
+    is the (exception, message) tuple if the entry could not be parsed, else
+    None. These results are cached, see parse_cache.result_format.
+
+    With a ``timeout`` (seconds) the parsing is interrupted by SIGALRM, the
+    process and its warm parsers survive. The alarm repeats every second in
+    case x4i3 swallows the EntryTimeoutError somewhere. Not available on
+    platforms without ``signal.setitimer``.
+    """
+    import signal
     import pyparsing
     from x4i3 import exfor_exceptions
     from x4i3tools.entry_generators import processEntry
 
-    dbPath, file_list = work_package
-
-    thr_coupledReactionEntries = {}
-    thr_monitoredReactionEntries = {}
-    thr_reactionCount = {}
-    thr_sql_transactions = []
-    thr_buggyEntries = {}
-
-    for f in file_list:
+    timeout = timeout if hasattr(signal, "setitimer") else None
+    sql_transactions = []
+    coupledReactionEntries = {}
+    monitoredReactionEntries = {}
+    reactionCount = {}
+    bibText = []
+    year = None
+    error = None
+    if timeout:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_entry_timeout)
+    try:
+        if timeout:
+            _set_entry_alarm(timeout, min(timeout, 1.0))
         try:
-            processEntry(
-                f,
-                thr_sql_transactions,
-                thr_coupledReactionEntries,
-                thr_monitoredReactionEntries,
-                thr_reactionCount,
-                dbPath,
+            year = processEntry(
+                name,
+                sql_transactions,
+                coupledReactionEntries,
+                monitoredReactionEntries,
+                reactionCount,
+                entrySource,
+                bibText=bibText,
             )
         except (
             exfor_exceptions.IsomerMathParsingError,
@@ -34,27 +319,916 @@ def process_file_package(work_package):
             exfor_exceptions.ReactionParsingError,
             exfor_exceptions.BrokenNumberError,
         ) as err:
-            thr_buggyEntries[f] = (err, str(err))
-            continue
+            error = (err, str(err))
         except (Exception, pyparsing.ParseException) as err:
-            thr_buggyEntries[f] = (err, str(err))
-            continue
+            error = (err, str(err))
+        finally:
+            if timeout:
+                _set_entry_alarm(0)
+    except EntryTimeoutError as err:
+        # Raised while leaving the handlers above
+        _set_entry_alarm(0)
+        error = (err, str(err))
+    finally:
+        if timeout:
+            signal.signal(signal.SIGALRM, previous_handler)
+    if error is not None and isinstance(error[0], EntryTimeoutError):
+        # Whatever was collected before the timeout is incomplete. Recorded as
+        # a builtin TimeoutError, the error pickle must load without x4i3tools
+        return ParsedEntry([], {}, {}, {}, (TimeoutError(error[1]), error[1]), [], None)
+    return ParsedEntry(
+        sql_transactions,
+        coupledReactionEntries,
+        monitoredReactionEntries,
+        reactionCount,
+        error,
+        bibText,
+        year,
+    )
 
-    return (
+
+def process_file_package(work_package):
+    """
+    Index the entries of a workpackage (entrySource, file_list, parseCache).
+    Returns a PackageResult, the entry_records are EntryRecords. Entries
+    found in the parse cache are not parsed again, the cache_misses are the
+    (hash, pickled result) of the parsed ones for the parent to store.
+
+    Inside a pool worker the maps are returned empty and merged into the maps
+    of the worker instead, checkpoint then holds them pickled for the parent
+    to persist along with the rows (see buildMainIndex). If the worker has its
+    own sqlite file, the rows, entry records and checkpoint are written there
+    and returned empty. ``rss`` is the memory in use by the worker.
+
+    Entries that take longer than ``x4i3tools.entry_timeout`` seconds are
+    given up and recorded with a TimeoutError.
+    """
+    import pickle
+    import x4i3tools as x4t
+
+    entrySource, file_list, parseCache = work_package
+    start = time.time()
+
+    thr_coupledReactionEntries = {}
+    thr_monitoredReactionEntries = {}
+    thr_reactionCount = {}
+    thr_sql_transactions = []
+    thr_buggyEntries = {}
+    thr_entry_records = []
+    thr_cache_misses = []
+
+    for f in file_list:
+        fhash = x4t.content_hash(entrySource.read_bytes(f))
+        cached = parseCache.get(fhash) if parseCache is not None else None
+        if cached is not None:
+            result = ParsedEntry._make(cached)
+        else:
+            result = parse_entry(entrySource, f, x4t.entry_timeout)
+            # The outcome of a timeout depends on the budget, parse it again
+            timed_out = result.error is not None and isinstance(
+                result.error[0], TimeoutError
+            )
+            if parseCache is not None and not timed_out:
+                thr_cache_misses.append((fhash, pickle.dumps(tuple(result))))
+
+        thr_sql_transactions.extend(result.sql_transactions)
+        thr_coupledReactionEntries.update(result.coupled)
+        thr_monitoredReactionEntries.update(result.monitored)
+        for rxn, count in result.reactionCount.items():
+            thr_reactionCount[rxn] = thr_reactionCount.get(rxn, 0) + count
+        if result.error is not None:
+            thr_buggyEntries[f] = result.error
+        thr_entry_records.append(
+            entry_record(
+                entrySource, f, fhash, result.reactionCount, result.bibText, result.year
+            )
+        )
+
+    if _worker_maps is not None:
+        _worker_stats["busy"] += time.time() - start
+        _worker_stats["workpackages"] += 1
+        _worker_stats["end"] = time.time()
+        # Reduced inside the pool worker, only the rows go back to the parent
+        maps = (
+            thr_coupledReactionEntries,
+            thr_monitoredReactionEntries,
+            thr_reactionCount,
+            thr_buggyEntries,
+        )
+        checkpoint = pickle.dumps(maps)
+        merge_index_maps(_worker_maps, maps)
+        if _worker_db is not None:
+            # Rows, entry state and checkpoint are committed together
+            cursor = _worker_db.cursor()
+            cursor.execute("BEGIN")
+            insert_index_rows(cursor, thr_sql_transactions, thr_entry_records)
+            cursor.execute("insert into checkpoint values(?)", (checkpoint,))
+            cursor.execute("COMMIT")
+            thr_sql_transactions, thr_entry_records, checkpoint = [], [], None
+        return PackageResult(
+            {},
+            {},
+            {},
+            thr_sql_transactions,
+            {},
+            thr_entry_records,
+            thr_cache_misses,
+            checkpoint,
+            x4t.current_rss(),
+        )
+
+    return PackageResult(
         thr_coupledReactionEntries,
         thr_monitoredReactionEntries,
         thr_reactionCount,
         thr_sql_transactions,
         thr_buggyEntries,
+        thr_entry_records,
+        thr_cache_misses,
+        None,
+        None,
+    )
+
+
+# Columns of the rows of theworks
+_theworks_columns = "entry text, subent text, pointer text, author text, reaction text, projectile text, target text, quantity text, rxncombo bool, monitored bool"
+
+
+def create_index_tables(cursor, normalized=True):
+    """
+    Create the tables of the main index.
+
+    The rows of ``theworks`` (one per author and reaction of a data set) are
+    stored normalized: entries, subentries, reactions and authors get integer
+    ids, a data set links a subentry pointer to a reaction and its authors are
+    linked in ``dataset_authors``. ``theworks`` is a view joining them, which
+    keeps the queries of x4i3 working. Rows are inserted into the staging
+    table ``theworks_rows`` and moved with load_staged_rows. With
+    ``normalized=False``, as in the files of the pool workers, ``theworks`` is
+    a plain table.
+
+    Besides, the index keeps the content hash, modification time and size of
+    every entry (``entrystate``) and its contribution to the reaction counts
+    (``entryreactions``, indexed by entry) to re-index only modified entries
+    later on.
+
+    The free text of the BIB sections goes to ``bibtext``, an FTS5 table in
+    the main index (a plain table in the files of the pool workers, or if
+    sqlite was built without FTS5), the publication year of the entries to
+    ``entryyears``.
+    """
+    if not normalized:
+        cursor.execute(
+            "create table if not exists theworks ({0})".format(_theworks_columns)
+        )
+    else:
+        create_staging_table(cursor)
+        cursor.execute(
+            """create table if not exists entries (id integer primary key, entry text unique)"""
+        )
+        cursor.execute(
+            """create table if not exists subentries (id integer primary key, entry integer, subent text, unique (entry, subent))"""
+        )
+        cursor.execute(
+            """create table if not exists reactions (id integer primary key, reaction text, projectile text, target text, quantity text, unique (reaction, projectile, target, quantity))"""
+        )
+        cursor.execute(
+            """create table if not exists authors (id integer primary key, author text unique)"""
+        )
+        cursor.execute(
+            """create table if not exists datasets (id integer primary key, subentry integer, pointer text, reaction integer, rxncombo bool, monitored bool, unique (subentry, pointer, reaction, rxncombo, monitored))"""
+        )
+        cursor.execute(
+            """create table if not exists dataset_authors (dataset integer, author integer)"""
+        )
+        cursor.execute(
+            """create view if not exists theworks as
+            select e.entry as entry, s.subent as subent, d.pointer as pointer,
+                a.author as author, r.reaction as reaction,
+                r.projectile as projectile, r.target as target,
+                r.quantity as quantity, d.rxncombo as rxncombo,
+                d.monitored as monitored
+            from dataset_authors da
+            join datasets d on d.id = da.dataset
+            join subentries s on s.id = d.subentry
+            join entries e on e.id = s.entry
+            join reactions r on r.id = d.reaction
+            join authors a on a.id = da.author"""
+        )
+    cursor.execute(
+        """create table if not exists entrystate (entry text primary key, name text, hash text, mtime real, size integer)"""
+    )
+    cursor.execute(
+        """create table if not exists entryreactions (entry text, reaction text, quantity text, count integer)"""
+    )
+    cursor.execute(
+        "create index if not exists entryreactions_entry on entryreactions (entry)"
+    )
+    cursor.execute(
+        """create table if not exists entryyears (entry text primary key, year integer)"""
+    )
+    create_bib_text_table(cursor, fts=normalized)
+
+
+def create_staging_table(cursor):
+    """
+    Create the staging table ``theworks_rows`` of a normalized index, which is
+    dropped again before the index is shipped (see compact_index).
+    """
+    cursor.execute(
+        "create table if not exists theworks_rows ({0})".format(_theworks_columns)
+    )
+
+
+def create_bib_text_table(cursor, fts=True):
+    """Create the ``bibtext`` table, full-text indexed with ``fts``."""
+    import sqlite3
+
+    if fts:
+        try:
+            cursor.execute(
+                """create virtual table if not exists bibtext using fts5 (entry unindexed, subent unindexed, title, institute, facility, method, freetext)"""
+            )
+            return
+        except sqlite3.OperationalError as err:  # pylint: disable=no-member
+            print("No full-text index for the BIB sections:", err)
+    cursor.execute(
+        """create table if not exists bibtext (entry text, subent text, title text, institute text, facility text, method text, freetext text)"""
     )
 
 
-def buildMainIndex():
+def search_bib_text(query, limit=None):
+    """
+    Search the BIB sections with an FTS5 ``query``, e.g.
+    ``'"time-of-flight" AND geel'``, and return the (entry, subent) of the
+    matches, best first.
+    """
+    import sqlite3
+    import x4i3tools as x4t
+
+    connection = sqlite3.connect(x4t.currentIndexFileName)  # pylint: disable=no-member
+    sql = "select entry, subent from bibtext where bibtext match ? order by rank"
+    parameters = (query,)
+    if limit is not None:
+        sql += " limit ?"
+        parameters += (limit,)
+    try:
+        return connection.execute(sql, parameters).fetchall()
+    finally:
+        connection.close()
+
+
+# Aggregate tables of the index: name, key columns and the rows they count
+_dataset_columns = "entry, subent, pointer, reaction, projectile, target, quantity, rxncombo, monitored"
+summary_tables = [
+    ("summary_target", "target, projectile, quantity", "theworks"),
+    ("summary_reaction", "target, reaction, quantity", "theworks"),
+    ("summary_author", "author", "theworks"),
+    (
+        "summary_year",
+        "year",
+        "(select t.*, ifnull(y.year, 0) as year from theworks t "
+        + "join entryyears y on y.entry = t.entry)",
+    ),
+]
+
+
+def has_summary_tables(cursor):
+    """Whether the index has the aggregate tables of create_summary_tables."""
+    return (
+        cursor.execute(
+            "select name from sqlite_master where name = ?", (summary_tables[0][0],)
+        ).fetchone()
+        is not None
+    )
+
+
+def create_summary_tables(cursor):
+    """
+    Create the aggregate tables of the index. Every table counts the
+    entries, subentries and data sets of its key: (target, projectile,
+    quantity), (target, reaction, quantity), author and the publication year
+    of the entry (0 if unknown). The counts are filled and kept up to date
+    with update_summary_tables, so summaries do not have to group all of
+    ``theworks``.
+    """
+    for table, keys, _ in summary_tables:
+        cursor.execute(
+            """create table if not exists {0} ({1}, entries integer, subentries integer, datasets integer, primary key ({1}))""".format(
+                table, keys
+            )
+        )
+        cursor.execute(
+            "create index if not exists {0}_datasets on {0} (datasets)".format(table)
+        )
+
+
+def update_summary_tables(cursor, accnums=None, sign=1):
+    """
+    Add (``sign=1``) or subtract (``sign=-1``) the counts of the entries
+    ``accnums`` in ``theworks`` to the aggregate tables, or those of the whole
+    index if ``accnums`` is None. An entry is counted completely or not at
+    all, so the counts of entries are additive: the counts of entries about to
+    be removed are subtracted before their rows are deleted and those of new
+    rows added after they have been inserted.
+    """
+    import x4i3tools as x4t
+
+    chunks = [None] if accnums is None else x4t.chunks(sorted(accnums), 500)
+    for chunk in chunks:
+        where, parameters = "", ()
+        if chunk is not None:
+            where = "where entry in ({0})".format(",".join("?" * len(chunk)))
+            parameters = tuple(chunk)
+        for table, keys, source in summary_tables:
+            cursor.execute(
+                """insert into {0} ({1}, entries, subentries, datasets)
+                select {1}, {2} * count(distinct entry),
+                    {2} * count(distinct subent), {2} * count(*)
+                from (select distinct {1}, {3} from {4} {5})
+                where true group by {1}
+                on conflict ({1}) do update set
+                    entries = entries + excluded.entries,
+                    subentries = subentries + excluded.subentries,
+                    datasets = datasets + excluded.datasets""".format(
+                    table, keys, int(sign), _dataset_columns, source, where
+                ),
+                parameters,
+            )
+    if sign < 0:
+        for table, _, _ in summary_tables:
+            cursor.execute("delete from {0} where datasets <= 0".format(table))
+
+
+def build_summary_tables(cursor):
+    """(Re)build the aggregate tables from all of ``theworks`` in one transaction."""
+    cursor.execute("BEGIN")
+    create_summary_tables(cursor)
+    for table, _, _ in summary_tables:
+        cursor.execute("delete from {0}".format(table))
+    update_summary_tables(cursor)
+    cursor.execute("COMMIT")
+
+
+def print_index_summary(limit=10):
+    """Print the largest rows of the aggregate tables, by number of data sets."""
+    import sqlite3
+    import x4i3tools as x4t
+
+    connection = sqlite3.connect(x4t.currentIndexFileName)  # pylint: disable=no-member
+    cursor = connection.cursor()
+    if not has_summary_tables(cursor):
+        raise IOError(
+            "The index", x4t.currentIndexFileName, "has no aggregate tables.",
+            "Rebuild it with the -f (force) flag.",
+        )
+    for table, keys, _ in summary_tables:
+        print("{0} (top {1} by data sets):".format(keys, limit))
+        print(
+            "\t{0:40s} {1:>8s} {2:>10s} {3:>8s}".format(
+                keys, "entries", "subentries", "datasets"
+            )
+        )
+        for row in cursor.execute(
+            "select * from {0} order by datasets desc limit ?".format(table),
+            (limit,),
+        ):
+            print(
+                "\t{0:40s} {1:8d} {2:10d} {3:8d}".format(
+                    ", ".join(str(key) for key in row[:-3]), *row[-3:]
+                )
+            )
+    connection.close()
+
+
+def create_search_indexes(cursor):
+    """
+    Create the indexes for the searches of x4i3 (see buildMainIndex) after
+    the bulk load and update the statistics of the query planner. Entries and
+    authors are found through their unique constraints, subentries, targets,
+    projectiles and quantities need their own index, and the data sets and
+    their authors are reached from a reaction or an author (or the other way
+    round, when entries are removed).
+    """
+    for name, table, columns in [
+        ("subentries_subent", "subentries", "subent"),
+        ("reactions_target", "reactions", "target, quantity"),
+        ("reactions_projectile", "reactions", "projectile"),
+        ("reactions_quantity", "reactions", "quantity"),
+        ("datasets_reaction", "datasets", "reaction"),
+        ("dataset_authors_author", "dataset_authors", "author"),
+        ("dataset_authors_dataset", "dataset_authors", "dataset"),
+    ]:
+        cursor.execute(
+            "create index if not exists {0} on {1} ({2})".format(name, table, columns)
+        )
+    cursor.execute("analyze")
+
+
+def benchmark_index_queries(nrepeat=20):
+    """
+    Time the searches x4i3 runs on ``theworks`` (author, target, reaction,
+    projectile, quantity, SUBENT, ENTRY and a combination of them) and a
+    full-text search of the BIB sections with values taken from the index,
+    and print their query plans. Plans that scan one of the large tables are
+    flagged.
+    """
+    import sqlite3
+    import x4i3tools as x4t
+
+    connection = sqlite3.connect(x4t.currentIndexFileName)  # pylint: disable=no-member
+    cursor = connection.cursor()
+    # The most frequent values, as an interactive search would use them
+    row = cursor.execute(
+        "select entry, subent, author, reaction, projectile, target, quantity "
+        + "from theworks where author = (select author from theworks "
+        + "group by author order by count(*) desc limit 1) limit 1"
+    ).fetchone()
+    if row is None:
+        print("The index", x4t.currentIndexFileName, "is empty")
+        cursor.close()
+        return
+    entry, subent, author, reaction, projectile, target, quantity = row
+    queries = [
+        ("author", "author = ?", (author,)),
+        ("target", "target = ?", (target,)),
+        ("reaction", "reaction = ?", (reaction,)),
+        ("projectile", "projectile = ?", (projectile,)),
+        ("quantity", "quantity = ?", (quantity,)),
+        ("SUBENT", "subent = ?", (subent,)),
+        ("ENTRY", "entry = ?", (entry,)),
+        (
+            "target, reaction, quantity",
+            "target = ? and reaction = ? and quantity = ?",
+            (target, reaction, quantity),
+        ),
+    ]
+    queries = [
+        (name, "select subent from theworks where " + condition, parameters)
+        for name, condition, parameters in queries
+    ]
+    # A word of the longest title for the full-text index
+    title = cursor.execute(
+        "select title from bibtext order by length(title) desc limit 1"
+    ).fetchone()
+    if title is not None and title[0].split():
+        word = max(title[0].split(), key=len).strip(".,;:()")
+        queries.append(
+            (
+                "BIB full text",
+                "select subent from bibtext where bibtext match ?",
+                ('"' + word + '"',),
+            )
+        )
+    large_tables = ["datasets", "dataset_authors", "theworks"]
+    for name, query, parameters in queries:
+        plan = [
+            row[-1]
+            for row in cursor.execute("explain query plan " + query, parameters)
+        ]
+        timings = []
+        for _ in range(nrepeat):
+            start = time.time()
+            nresults = len(cursor.execute(query, parameters).fetchall())
+            timings.append(time.time() - start)
+        timings.sort()
+        scans = [
+            detail
+            for detail in plan
+            if detail.startswith("SCAN")
+            and detail.split()[1] in large_tables + ["d", "da"]
+        ]
+        print(
+            "{0:28s} {1:6d} rows {2:9.3f} ms{3}".format(
+                name,
+                nresults,
+                1e3 * timings[len(timings) // 2],
+                "  FULL SCAN" if scans else "",
+            )
+        )
+        if x4t.verbose or scans:
+            for detail in plan:
+                print("\t" + detail)
+    cursor.close()
+
+
+# Joins of the staged rows to the ids of the normalized tables, null safe
+_staged_entry = "join entries e on e.entry is t.entry"
+_staged_subentry = (
+    _staged_entry + " join subentries s on s.entry = e.id and s.subent is t.subent"
+)
+_staged_reaction = (
+    "join reactions r on r.reaction is t.reaction and r.projectile is t.projectile"
+    + " and r.target is t.target and r.quantity is t.quantity"
+)
+_staged_dataset = (
+    "join datasets d on d.subentry = s.id and d.pointer is t.pointer"
+    + " and d.reaction = r.id and d.rxncombo is t.rxncombo"
+    + " and d.monitored is t.monitored"
+)
+
+
+def load_staged_rows(cursor):
+    """
+    Move the rows in the staging table ``theworks_rows`` into the normalized
+    tables, adding the entries, subentries, reactions, authors and data sets
+    not known yet. Every staged row becomes one link in ``dataset_authors``,
+    so the view returns exactly the staged rows. The new rows are inserted in
+    key order, i.e. appended to the b-trees.
+    """
+    cursor.execute(
+        """insert into entries (entry) select distinct t.entry from theworks_rows t
+        where not exists (select 1 from entries e where e.entry is t.entry)
+        order by t.entry"""
+    )
+    cursor.execute(
+        """insert into subentries (entry, subent)
+        select distinct e.id, t.subent from theworks_rows t {0}
+        where not exists (
+            select 1 from subentries s where s.entry = e.id and s.subent is t.subent
+        )
+        order by e.id, t.subent""".format(
+            _staged_entry
+        )
+    )
+    cursor.execute(
+        """insert into reactions (reaction, projectile, target, quantity)
+        select distinct t.reaction, t.projectile, t.target, t.quantity
+        from theworks_rows t where not exists (select 1 from reactions r {0})
+        order by t.reaction, t.projectile, t.target, t.quantity""".format(
+            _staged_reaction.replace("join reactions r on", "where")
+        )
+    )
+    cursor.execute(
+        """insert into authors (author) select distinct t.author from theworks_rows t
+        where not exists (select 1 from authors a where a.author is t.author)
+        order by t.author"""
+    )
+    cursor.execute(
+        """insert into datasets (subentry, pointer, reaction, rxncombo, monitored)
+        select distinct s.id, t.pointer, r.id, t.rxncombo, t.monitored
+        from theworks_rows t {0} {1}
+        where not exists (select 1 from datasets d {2})
+        order by s.id, t.pointer, r.id""".format(
+            _staged_subentry,
+            _staged_reaction,
+            _staged_dataset.replace("join datasets d on", "where"),
+        )
+    )
+    cursor.execute(
+        """insert into dataset_authors (dataset, author)
+        select d.id, a.id from theworks_rows t {0} {1} {2}
+        join authors a on a.author is t.author
+        order by d.id""".format(
+            _staged_subentry, _staged_reaction, _staged_dataset
+        )
+    )
+    cursor.execute("delete from theworks_rows")
+
+
+def delete_index_rows(cursor, accnum):
+    """
+    Remove the rows of an entry from the normalized tables, returns their
+    number. Reactions and authors stay, they may be used by other entries.
+    """
+    nrows = cursor.execute(
+        "select count(*) from theworks where entry = ?", (accnum,)
+    ).fetchone()[0]
+    subentries = "select s.id from subentries s join entries e on e.id = s.entry where e.entry = ?"
+    cursor.execute(
+        "delete from dataset_authors where dataset in "
+        + "(select id from datasets where subentry in ({0}))".format(subentries),
+        (accnum,),
+    )
+    cursor.execute(
+        "delete from datasets where subentry in ({0})".format(subentries), (accnum,)
+    )
+    cursor.execute(
+        "delete from subentries where entry in (select id from entries where entry = ?)",
+        (accnum,),
+    )
+    cursor.execute("delete from entries where entry = ?", (accnum,))
+    return nrows
+
+
+def insert_index_rows(cursor, sql_transactions, entry_records, staged=False):
+    """
+    Insert the results of process_file_package into the index tables. With
+    ``staged`` the rows go through the staging table of a normalized index.
+    """
+    cursor.executemany(
+        "insert into {0} values(?,?,?,?,?,?,?,?,?,?)".format(
+            "theworks_rows" if staged else "theworks"
+        ),
+        sql_transactions,
+    )
+    if staged:
+        load_staged_rows(cursor)
+    cursor.executemany(
+        "insert into entrystate values(?,?,?,?,?)",
+        [
+            (record.accnum, record.name, record.hash, record.mtime, record.size)
+            for record in entry_records
+        ],
+    )
+    cursor.executemany(
+        "insert into entryreactions values(?,?,?,?)",
+        [
+            (record.accnum,) + tuple(rxn) + (count,)
+            for record in entry_records
+            for rxn, count in record.reactionCount.items()
+        ],
+    )
+    cursor.executemany(
+        "insert into bibtext values(?,?,?,?,?,?,?)",
+        [row for record in entry_records for row in record.bibText],
+    )
+    cursor.executemany(
+        "insert into entryyears values(?,?)",
+        [(record.accnum, record.year) for record in entry_records],
+    )
+
+
+def index_in_pool(
+    entrySource, files_to_process, consume, indexFileName=None, worker_pids=None
+):
+    """
+    Index the entries in a process pool, see buildMainIndex.
+
+    ``consume`` is called with the result of every workpackage in order of
+    completion while the workers keep parsing. The maps are reduced inside the
+    workers, collected once per worker at the end and returned as a
+    (coupled, monitored, reactionCount, buggy) tuple.
+
+    With ``indexFileName`` every worker writes its rows to its own sqlite file
+    next to it, see merge_worker_index_files. The process ids of the workers
+    are appended to the ``worker_pids`` list, if one is given.
+
+    If ``x4i3tools.parse_cache`` is set, the workers look the entries up in
+    this cache first and the entries they had to parse are added to it.
+    """
+    from multiprocessing import Barrier, Pool
+    from tqdm import tqdm
+    import x4i3tools as x4t
+
+    parseCache = x4t.parse_cache
+    if parseCache is not None:
+        parseCache.create()
+
+    # Balance the work per thread by the size of the entries
+    workpackages = [
+        (entrySource, chunk, parseCache)
+        for chunk in schedule_workpackages(
+            files_to_process,
+            [entrySource.entry_size(f) for f in files_to_process],
+            x4t.nthreads,
+        )
+    ]
+    print("Workpackages: ", len(workpackages))
+
+    if x4t.verbose:
+        print(
+            "Will process {0} files in {1} workpackages using {2} threads.".format(
+                len(files_to_process), len(workpackages), x4t.nthreads
+            )
+        )
+
+    # Forked workers inherit the grammars and dictionaries built by the imports
+    # in the parent, the initializer warms up the rest on the smallest entry
+    warm_up_parsers()
+    sample = min(files_to_process, key=entrySource.entry_size)
+
+    # A worker that grew beyond max_worker_memory stops the dispatch of new
+    # workpackages. The pending ones are finished, the maps drained and the
+    # remaining workpackages, if any, continue in a fresh pool. The whole pool
+    # is recycled since the maps are drained from all workers at once, behind
+    # a barrier.
+    remaining = iter(workpackages)
+    dispatched = 0
+    recycle = False
+
+    def dispatch():
+        nonlocal dispatched
+        while not recycle:
+            wp = next(remaining, None)
+            if wp is None:
+                return
+            dispatched += 1
+            yield wp
+
+    # The number of results in flight is bounded by imap_bounded (and the
+    # --max-memory ceiling of the parent process)
+    cache_misses = 0
+    worker_maps = []
+    progress = tqdm(total=len(workpackages))
+    while True:
+        start = time.time()
+        with Pool(
+            x4t.nthreads,
+            initializer=init_index_worker,
+            initargs=(Barrier(x4t.nthreads), entrySource, sample, indexFileName),
+        ) as mpool:
+            for wp in x4t.imap_bounded(
+                mpool, process_file_package, dispatch(), ordered=False
+            ):
+                consume(wp)
+                if parseCache is not None and wp.cache_misses:
+                    parseCache.store(wp.cache_misses)
+                    cache_misses += len(wp.cache_misses)
+                if x4t.above_memory(wp.rss, x4t.max_worker_memory):
+                    recycle = True
+                progress.update()
+
+            pool_maps, worker_stats = zip(
+                *mpool.map(drain_worker_maps, range(x4t.nthreads), chunksize=1)
+            )
+        worker_maps.extend(pool_maps)
+        if worker_pids is not None:
+            worker_pids.extend(stats["pid"] for stats in worker_stats)
+        report_worker_stats(worker_stats, start)
+        if not recycle or dispatched == len(workpackages):
+            break
+        print("Recycling the pool workers, a worker exceeded --max-worker-memory")
+        recycle = False
+    progress.close()
+
+    if parseCache is not None:
+        print(
+            "Parse cache: {0} hits, {1} misses".format(
+                len(files_to_process) - cache_misses, cache_misses
+            )
+        )
+    return tree_reduce(merge_index_maps, worker_maps)
+
+
+def copy_index_rows(cursor, file_name, tables, skip_indexed=False):
+    """
+    Copy the rows of ``tables`` from another index file into the index of
+    ``cursor`` inside sqlite (ATTACH + INSERT ... SELECT), in one
+    transaction. The rows of ``theworks`` (a table or a view in the other
+    file) go to the staging table, see load_staged_rows. With
+    ``skip_indexed`` the rows of entries that are already in ``entrystate``
+    are left out.
+    """
+    cursor.execute("attach database ? as other", (str(file_name),))
+    cursor.execute("BEGIN")
+    for table in tables:
+        where = ""
+        if skip_indexed and table != "checkpoint":
+            where = " where entry not in (select entry from main.entrystate)"
+        # entrystate comes last, the filter must not see the copied entries
+        cursor.execute(
+            "insert into main.{0} select * from other.{1}{2}".format(
+                "theworks_rows" if table == "theworks" else table, table, where
+            )
+        )
+    cursor.execute("COMMIT")
+    cursor.execute("detach database other")
+
+
+def worker_index_files(indexFileName, pids=None):
+    """
+    The files written by the pool workers with the process ids ``pids``, or
+    all worker files next to the index if ``pids`` is None.
+    """
+    import glob
+
+    if pids is not None:
+        return [
+            worker_index_file_name(indexFileName, pid)
+            for pid in sorted(set(pids))
+            if os.path.exists(worker_index_file_name(indexFileName, pid))
+        ]
+    # the workers journal with WAL, skip the -wal and -shm files next to them
+    return sorted(
+        file_name
+        for file_name in glob.glob(worker_index_file_name(indexFileName, "*"))
+        if not file_name.endswith(("-wal", "-shm"))
+    )
+
+
+def remove_worker_index_file(file_name):
+    """Remove a worker file and its WAL files."""
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(file_name + suffix):
+            os.remove(file_name + suffix)
+
+
+def merge_worker_index_files(cursor, indexFileName, pids=None):
+    """
+    Move the rows written by the pool workers with the process ids ``pids``
+    to their own files into the index. Without ``pids`` all worker files are
+    merged, as when resuming an interrupted build, rows of entries that made
+    it into the index before are skipped.
+
+    The rows of all files are staged first and loaded into the normalized
+    tables at once, in key order. Rows staged by an interrupted merge are
+    loaded along with them.
+    """
+    worker_files = worker_index_files(indexFileName, pids)
+    for file_name in worker_files:
+        copy_index_rows(
+            cursor,
+            file_name,
+            [
+                "theworks",
+                "entryreactions",
+                "entryyears",
+                "bibtext",
+                "entrystate",
+                "checkpoint",
+            ],
+            skip_indexed=True,
+        )
+        remove_worker_index_file(file_name)
+    cursor.execute("BEGIN")
+    load_staged_rows(cursor)
+    cursor.execute("COMMIT")
+    return len(worker_files)
+
+
+def set_bulk_load_pragmas(cursor):
+    """
+    Settings for loading an index in bulk. The WAL journal without syncing
+    keeps the committed transactions of a crashed build (see resume), only
+    a crash of the machine may lose them.
+    """
+    cursor.execute("pragma journal_mode = wal")
+    cursor.execute("pragma synchronous = off")
+    cursor.execute("pragma cache_size = -262144")
+    cursor.execute("pragma temp_store = memory")
+
+
+def compact_index(connection, indexFileName):
+    """
+    Drop the staging table, switch back to the default journal, write a
+    compacted copy of the index with ``VACUUM INTO`` and replace the index by
+    it. Closes ``connection``.
+    """
+    import sqlite3
+
+    cursor = connection.cursor()
+    cursor.execute("drop table if exists theworks_rows")
+    cursor.execute("pragma journal_mode = delete")
+    cursor.execute("pragma synchronous = full")
+    compacted = str(indexFileName) + ".compact"
+    if os.path.exists(compacted):
+        os.remove(compacted)
+    if sqlite3.sqlite_version_info >= (3, 27, 0):
+        cursor.execute("vacuum into ?", (compacted,))
+        cursor.close()
+        connection.close()
+        os.replace(compacted, indexFileName)
+    else:
+        cursor.execute("vacuum")
+        cursor.close()
+        connection.close()
+
+
+def report_phase_timings(timings):
+    """Print the (phase, seconds) timings of a build."""
+    print("Phase timings:")
+    for phase, seconds in timings:
+        print("\t{0:24s} {1:8.1f} s".format(phase, seconds))
+
+
+def dump_pickle(obj, file_name):
+    """Replace a pickle atomically, readers never see a partially written file."""
+    import pickle
+
+    with open(str(file_name) + ".tmp", mode="wb") as f:
+        pickle.dump(obj, f)
+    os.replace(str(file_name) + ".tmp", file_name)
+
+
+def load_pickle(file_name):
+    """Load a pickle written by dump_pickle."""
+    import pickle
+
+    with open(file_name, mode="rb") as f:
+        return pickle.load(f)
+
+
+def remove_if_force(file_name):
+    """Remove the output of a previous run, only with the -f (force) flag."""
+    import x4i3tools as x4t
+
+    if os.path.exists(file_name) and x4t.force:
+        os.remove(file_name)
+    elif os.path.exists(file_name):
+        raise IOError(
+            "Can not overwrite file", file_name, "Consider using -f (force) flag."
+        )
+
+
+def buildMainIndex(incremental=False, resume=False, shard=None):
     """
     This function build up the index of the database.
 
-    The database is assumed to be in the ``x4i/data/db`` directory (set by the
-    ``dbPath`` global variable).  The directory is arranged as follows ::
+    The entries are read from ``x4i3tools.currentEntrySource`` if it is set
+    (e.g. directly from an X4 master zip file), otherwise the database is
+    assumed to be in the ``currentDBPath`` directory.  The directory is
+    arranged as follows ::
 
         db/001/00011.x4
                00012.x4
@@ -85,85 +1259,142 @@ def buildMainIndex():
 
         ENTRY = None
 
+    With ``incremental=True`` an existing index is updated instead, only the
+    new, modified and removed entries are re-indexed (see
+    reindex_changed_entries).
+
+    The pool workers write the rows to their own sqlite files, which are
+    merged into the index at the end. The maps of every workpackage are stored
+    in a ``checkpoint`` table in the same transaction as its rows, until the
+    pickles have been written. With ``resume=True`` an interrupted build
+    continues with the entries that are not yet in the ``entrystate`` table
+    of the index or of the files of the workers.
+
+    With ``shard`` only the entries of this shard are indexed (see
+    select_shard), use set_current_shard to write them to the shard directory
+    and merge_index_shards to combine the shards.
     """
     import glob
+    import pathlib
     import pickle
     import pprint
-    import random
     import sqlite3
-    from tqdm import tqdm
-
-    from multiprocessing import Pool
 
     import pyparsing
     from x4i3 import exfor_exceptions
     import x4i3tools as x4t
+    from x4i3tools.entry_sources import DirectoryEntrySource
 
-    def remove_if_force(file_name):
-        if os.path.exists(file_name) and x4t.force:
-            os.remove(file_name)
-        elif os.path.exists(file_name):
-            raise IOError(
-                "Can not overwrite file", file_name, "Consider using -f (force) flag."
-            )
+    # build up the table, reading from the X4 master zip file if one is set
+    entrySource = x4t.currentEntrySource or DirectoryEntrySource(x4t.currentDBPath)
+    if incremental:
+        return reindex_changed_entries(entrySource)
 
     # clean up previous runs
-    remove_if_force(x4t.currentIndexFileName)
-    remove_if_force(x4t.currentErrorFileName)
-    remove_if_force(x4t.currentCoupledFileName)
-    remove_if_force(x4t.currentReactionCountFileName)
-    remove_if_force(x4t.currentMonitoredFileName)
+    if not resume:
+        remove_if_force(x4t.currentIndexFileName)
+        remove_if_force(x4t.currentErrorFileName)
+        remove_if_force(x4t.currentCoupledFileName)
+        remove_if_force(x4t.currentReactionCountFileName)
+        remove_if_force(x4t.currentMonitoredFileName)
+        # Rows of an interrupted build must not be merged into this one
+        for file_name in glob.glob(
+            worker_index_file_name(x4t.currentIndexFileName, "*")
+        ):
+            os.remove(file_name)
+    elif not os.path.exists(x4t.currentIndexFileName):
+        raise IOError("No index to resume found at", x4t.currentIndexFileName)
 
-    # build up the table
     if x4t.verbose:
-        print(x4t.currentDBPath.glob("**/*.x4"))
+        print("Reading entries from", entrySource)
 
-    files_to_process = list(x4t.currentDBPath.glob("**/*.x4"))
+    files_to_process = entrySource.list_entries()
+    if shard is not None:
+        files_to_process = select_shard(
+            files_to_process,
+            [entrySource.entry_size(f) for f in files_to_process],
+            shard,
+        )
+        print("Shard", shard)
     total_files = len(files_to_process)
-    chunksize = min(total_files // x4t.nthreads, 50)
-    print(x4t.currentDBPath, total_files)
-    assert total_files > 0, "No files found in " + x4t.currentDBPath.name
+    print(entrySource, total_files)
+    assert total_files > 0, "No files found in " + repr(entrySource)
 
-    if x4t.verbose:
+    # set up database & create the tables, transactions are managed explicitly
+    timings = []
+    phase_start = time.time()
+    connection = sqlite3.connect(x4t.currentIndexFileName)  # pylint: disable=no-member
+    connection.isolation_level = None
+    cursor = connection.cursor()
+    set_bulk_load_pragmas(cursor)
+
+    maps = ({}, {}, {}, {})
+    if resume:
+        if not cursor.execute(
+            "select name from sqlite_master where type='table' and name='checkpoint'"
+        ).fetchone():
+            raise IOError(
+                "The index", x4t.currentIndexFileName, "has no checkpoint to resume."
+            )
+        merge_worker_index_files(cursor, x4t.currentIndexFileName)
+        for (checkpoint,) in cursor.execute("select maps from checkpoint"):
+            merge_index_maps(maps, pickle.loads(checkpoint))
+        # A checkpoint may have been merged twice, the counts of the indexed
+        # entries are exact
+        _, _, reactionCount, _ = maps
+        reactionCount.clear()
+        for reaction, quantity, count in cursor.execute(
+            "select reaction, quantity, sum(count) from entryreactions "
+            + "group by reaction, quantity"
+        ):
+            reactionCount[(reaction, quantity)] = count
+        done = set(entry for (entry,) in cursor.execute("select entry from entrystate"))
+        files_to_process = [
+            f for f in files_to_process if pathlib.PurePath(f).stem not in done
+        ]
         print(
-            "Will process {0} files in chunks of {1} using {2} threads.".format(
-                total_files, chunksize, x4t.nthreads
+            "Resuming: {0} entries indexed, {1} to go".format(
+                len(done), len(files_to_process)
             )
         )
+    create_index_tables(cursor)
+    cursor.execute("""create table if not exists checkpoint (maps blob)""")
+    timings.append(("setup", time.time() - phase_start))
 
-    # Shuffle the list to balance the work per thread
-    # random.shuffle(files_to_process)
-    workpackages = []
-    for chunk in x4t.chunks(files_to_process, chunksize):
-        workpackages.append((x4t.currentDBPath, chunk))
-    print("Workpackages: ", len(workpackages))
-    with Pool(x4t.nthreads) as mpool:
-        processed = list(
-            tqdm(
-                mpool.imap(process_file_package, workpackages), total=len(workpackages)
-            )
+    # The workers write their rows to their own sqlite files, which are merged
+    # into the index by sqlite at the end. Nothing but the parse cache misses
+    # travels back to the parent while the workers are parsing.
+    phase_start = time.time()
+    worker_pids = []
+    if files_to_process:
+        merge_index_maps(
+            maps,
+            index_in_pool(
+                entrySource,
+                files_to_process,
+                lambda wp: None,
+                indexFileName=x4t.currentIndexFileName,
+                worker_pids=worker_pids,
+            ),
         )
-        # processed = mpool.map(generate_entries_threads, workpackages)
-
-    coupledReactionEntries = {}
-    monitoredReactionEntries = {}
-    reactionCount = {}
-    sql_transactions = []
-    buggyEntries = {}
-
-    for wp in tqdm(processed):
-        (
-            wp_coupledReactionEntries,
-            wp_monitoredReactionEntries,
-            wp_reactionCount,
-            wp_sql_transactions,
-            wp_buggyEntries,
-        ) = wp
-        coupledReactionEntries.update(wp_coupledReactionEntries)
-        monitoredReactionEntries.update(wp_monitoredReactionEntries)
-        reactionCount.update(wp_reactionCount)
-        buggyEntries.update(wp_buggyEntries)
-        sql_transactions += wp_sql_transactions
+    timings.append(("parse", time.time() - phase_start))
+    phase_start = time.time()
+    merge_worker_index_files(cursor, x4t.currentIndexFileName, worker_pids)
+    timings.append(("load rows", time.time() - phase_start))
+    (
+        coupledReactionEntries,
+        monitoredReactionEntries,
+        reactionCount,
+        buggyEntries,
+    ) = maps
+    # The secondary indexes are built once, after the bulk load
+    phase_start = time.time()
+    create_search_indexes(cursor)
+    timings.append(("indexes", time.time() - phase_start))
+    phase_start = time.time()
+    build_summary_tables(cursor)
+    timings.append(("summaries", time.time() - phase_start))
+    nrows = cursor.execute("select count(*) from theworks").fetchone()[0]
 
     print("Files processed: ", total_files)
     print("Lenths:")
@@ -173,34 +1404,315 @@ def buildMainIndex():
         len(monitoredReactionEntries),
     )
     print("\tNumber of distinct reactions:", len(reactionCount))
-    print("\tsql_transactions:", len(sql_transactions))
+    print("\tsql_transactions:", nrows)
     print("\tErroneous entries:", len(buggyEntries))
     if x4t.verbose and len(buggyEntries) > 0:
         pprint.pprint(buggyEntries)
 
-    pickle.dump(coupledReactionEntries, open(x4t.currentCoupledFileName, mode="wb"))
-    pickle.dump(monitoredReactionEntries, open(x4t.currentMonitoredFileName, mode="wb"))
-    pickle.dump(reactionCount, open(x4t.currentReactionCountFileName, mode="wb"))
-    pickle.dump(buggyEntries, open(x4t.currentErrorFileName, mode="wb"))
+    phase_start = time.time()
+    dump_pickle(coupledReactionEntries, x4t.currentCoupledFileName)
+    dump_pickle(monitoredReactionEntries, x4t.currentMonitoredFileName)
+    dump_pickle(reactionCount, x4t.currentReactionCountFileName)
+    dump_pickle(buggyEntries, x4t.currentErrorFileName)
+    timings.append(("pickles", time.time() - phase_start))
 
-    # set up database & create the table
+    # The build is complete
+    phase_start = time.time()
+    cursor.execute("drop table checkpoint")
+    cursor.close()
+    compact_index(connection, x4t.currentIndexFileName)
+    timings.append(("compact", time.time() - phase_start))
+    report_phase_timings(timings)
+
+
+def reindex_changed_entries(entrySource):
+    """
+    Re-index only the entries of ``entrySource`` that changed since the index
+    was built.
+
+    An entry is unchanged if its modification time and size match the ones
+    stored in the ``entrystate`` table. Otherwise (or if the source has no
+    modification times) its content hash is compared. Entries that are no
+    longer in the source are removed from the index.
+    """
+    import pathlib
+    import sqlite3
+    import x4i3tools as x4t
+
+    if not os.path.exists(x4t.currentIndexFileName):
+        raise IOError("No index found at", x4t.currentIndexFileName)
     connection = sqlite3.connect(x4t.currentIndexFileName)  # pylint: disable=no-member
     cursor = connection.cursor()
-    cursor.execute(
-        """create table if not exists theworks (entry text, subent text, pointer text, author text, reaction text, projectile text, target text, quantity text, rxncombo bool, monitored bool)"""
+    if not cursor.execute(
+        "select name from sqlite_master where type='table' and name='entrystate'"
+    ).fetchone():
+        raise IOError(
+            "The index", x4t.currentIndexFileName, "has no entry state.",
+            "Rebuild it with the -f (force) flag.",
+        )
+    stored = {
+        accnum: (fhash, mtime, size)
+        for accnum, fhash, mtime, size in cursor.execute(
+            "select entry, hash, mtime, size from entrystate"
+        )
+    }
+    cursor.close()
+    connection.close()
+
+    current = {pathlib.PurePath(f).stem: f for f in entrySource.list_entries()}
+    changed = []
+    touched = []
+    for accnum, f in current.items():
+        mtime, size = entrySource.entry_stamp(f)
+        if accnum in stored:
+            fhash, old_mtime, old_size = stored[accnum]
+            if mtime is not None and (mtime, size) == (old_mtime, old_size):
+                continue
+            if x4t.content_hash(entrySource.read_bytes(f)) == fhash:
+                touched.append((mtime, size, accnum))
+                continue
+        changed.append(f)
+    removed = sorted(set(stored) - set(current))
+    print(
+        "Entries to re-index: {0} new or modified, {1} removed, {2} unchanged".format(
+            len(changed), len(removed), len(current) - len(changed)
+        )
     )
 
-    # Write all sql_entries to the database in one transaction
-    # cursor.execute('BEGIN TRANSACTION')
-    cursor.executemany(
-        "insert into theworks values(?,?,?,?,?,?,?,?,?,?)", sql_transactions
+    rows = []
+    records = []
+
+    def collect(wp):
+        rows.extend(wp.sql_transactions)
+        records.extend(wp.entry_records)
+
+    if changed:
+        coupled, monitored, reactionCount, buggy = index_in_pool(
+            entrySource, changed, collect
+        )
+    else:
+        coupled, monitored, reactionCount, buggy = {}, {}, {}, {}
+
+    accnums = [pathlib.PurePath(f).stem for f in changed] + removed
+    update_index_entries(
+        accnums,
+        PackageResult(
+            coupled, monitored, reactionCount, rows, buggy, records, [], None, None
+        ),
+        deleted=removed,
+        touched=touched,
     )
-    # cursor.execute('COMMIT')
 
-    # # commit & close connection to database
+
+def update_index_entries(accnums, new, deleted=(), touched=()):
+    """
+    Replace the contributions of the entries ``accnums`` to an existing index
+    and to the pickled maps in place, without touching the other entries.
+
+    ``new`` is the PackageResult of ``process_file_package`` for the current
+    version of these entries. The reaction counts of their previous version
+    are taken from the ``entryreactions`` table. The ``deleted`` entries are
+    not part of ``new`` and lose their DOI cross references. ``touched``
+    (mtime, size, accnum) tuples update the stamps of entries with unchanged
+    content.
+
+    The database is updated in a single transaction, the pickles are replaced
+    right after it has been committed.
+    """
+    import pathlib
+    import sqlite3
+    import x4i3tools as x4t
+
+    accnums = set(accnums)
+
+    connection = sqlite3.connect(x4t.currentIndexFileName)  # pylint: disable=no-member
+    cursor = connection.cursor()
+    if not cursor.execute(
+        "select name from sqlite_master where type='table' and name='entrystate'"
+    ).fetchone():
+        raise IOError(
+            "The index", x4t.currentIndexFileName, "has no entry state.",
+            "Rebuild it with the -f (force) flag.",
+        )
+    old_reactionCount = {}
+    for accnum in accnums:
+        for reaction, quantity, count in cursor.execute(
+            "select reaction, quantity, count from entryreactions where entry = ?",
+            (accnum,),
+        ):
+            rxn = (reaction, quantity)
+            old_reactionCount[rxn] = old_reactionCount.get(rxn, 0) + count
+
+    # entries with coupled/monitored data sets are keyed by (accnum, snum, p)
+    maps = {}
+    for file_name, new_entries in [
+        (x4t.currentCoupledFileName, new.coupled),
+        (x4t.currentMonitoredFileName, new.monitored),
+    ]:
+        entries = load_pickle(file_name)
+        entries = {k: v for k, v in entries.items() if k[0] not in accnums}
+        entries.update(new_entries)
+        maps[file_name] = entries
+
+    reactionCount = load_pickle(x4t.currentReactionCountFileName)
+    for rxn, count in old_reactionCount.items():
+        reactionCount[rxn] = reactionCount.get(rxn, 0) - count
+        if reactionCount[rxn] <= 0:
+            del reactionCount[rxn]
+    for rxn, count in new.reactionCount.items():
+        reactionCount[rxn] = reactionCount.get(rxn, 0) + count
+    maps[x4t.currentReactionCountFileName] = reactionCount
+
+    buggyEntries = load_pickle(x4t.currentErrorFileName)
+    buggyEntries = {
+        k: v
+        for k, v in buggyEntries.items()
+        if pathlib.PurePath(k).stem not in accnums
+    }
+    buggyEntries.update(new.buggy)
+    maps[x4t.currentErrorFileName] = buggyEntries
+
+    # Replace the rows in one transaction. Deleted entries also lose their DOIs
+    summaries = has_summary_tables(cursor)
+    if summaries:
+        update_summary_tables(cursor, accnums, sign=-1)
+    nremoved = 0
+    for accnum in accnums:
+        nremoved += delete_index_rows(cursor, accnum)
+    cursor.execute(
+        """create table if not exists entryyears (entry text primary key, year integer)"""
+    )
+    for table in ["entrystate", "entryreactions", "entryyears"]:
+        cursor.executemany(
+            "delete from {0} where entry = ?".format(table),
+            [(accnum,) for accnum in accnums],
+        )
+    # entry is not indexed in the FTS5 table, one scan per chunk
+    create_bib_text_table(cursor)
+    for chunk in x4t.chunks(sorted(accnums), 500):
+        cursor.execute(
+            "delete from bibtext where entry in ({0})".format(
+                ",".join("?" * len(chunk))
+            ),
+            chunk,
+        )
+    cursor.executemany(
+        "update entrystate set mtime = ?, size = ? where entry = ?", touched
+    )
+    create_staging_table(cursor)
+    insert_index_rows(cursor, new.sql_transactions, new.entry_records, staged=True)
+    cursor.execute("drop table theworks_rows")
+    if summaries:
+        update_summary_tables(cursor, accnums, sign=1)
+    if cursor.execute(
+        "select name from sqlite_master where type='table' and name='doiXref'"
+    ).fetchone():
+        cursor.executemany(
+            "delete from doiXref where entry = ?", [(accnum,) for accnum in deleted]
+        )
     connection.commit()
     cursor.close()
 
+    for file_name, obj in maps.items():
+        dump_pickle(obj, file_name)
+
+    if x4t.verbose:
+        print("Rows removed:", nremoved)
+        print("Rows inserted:", len(new.sql_transactions))
+
+
+def merge_index_shards(shard_dirs):
+    """
+    Combine index shards, directories written by buildMainIndex with
+    set_current_shard, into the index and pickles at the current paths.
+    The rows are copied between the sqlite files directly (ATTACH), the maps
+    are reduced like the maps of the pool workers.
+    """
+    import pathlib
+    import sqlite3
+    import x4i3tools as x4t
+
+    shard_dirs = [pathlib.Path(d) for d in shard_dirs]
+    if not shard_dirs:
+        raise IOError("No index shards to merge")
+    for file_name in [
+        x4t.currentIndexFileName,
+        x4t.currentErrorFileName,
+        x4t.currentCoupledFileName,
+        x4t.currentReactionCountFileName,
+        x4t.currentMonitoredFileName,
+    ]:
+        remove_if_force(file_name)
+
+    timings = []
+    phase_start = time.time()
+    connection = sqlite3.connect(x4t.currentIndexFileName)  # pylint: disable=no-member
+    connection.isolation_level = None
+    cursor = connection.cursor()
+    set_bulk_load_pragmas(cursor)
+    create_index_tables(cursor)
+    shard_maps = []
+    for shard_dir in shard_dirs:
+        print("Merging", shard_dir)
+        connection_shard = sqlite3.connect(  # pylint: disable=no-member
+            shard_dir / x4t.indexFileName
+        )
+        incomplete = connection_shard.execute(
+            "select name from sqlite_master where name='checkpoint'"
+        ).fetchone()
+        connection_shard.close()
+        if incomplete:
+            raise IOError("The index shard", shard_dir, "is incomplete.")
+        copy_index_rows(
+            cursor,
+            shard_dir / x4t.indexFileName,
+            ["theworks", "entryreactions", "entryyears", "bibtext", "entrystate"],
+        )
+        shard_maps.append(
+            tuple(
+                load_pickle(shard_dir / pathlib.Path(file_name).name)
+                for file_name in [
+                    x4t.currentCoupledFileName,
+                    x4t.currentMonitoredFileName,
+                    x4t.currentReactionCountFileName,
+                    x4t.currentErrorFileName,
+                ]
+            )
+        )
+    cursor.execute("BEGIN")
+    load_staged_rows(cursor)
+    cursor.execute("COMMIT")
+    timings.append(("load rows", time.time() - phase_start))
+    phase_start = time.time()
+    create_search_indexes(cursor)
+    timings.append(("indexes", time.time() - phase_start))
+    phase_start = time.time()
+    build_summary_tables(cursor)
+    timings.append(("summaries", time.time() - phase_start))
+    nrows = cursor.execute("select count(*) from theworks").fetchone()[0]
+    nentries = cursor.execute("select count(*) from entrystate").fetchone()[0]
+    cursor.close()
+    phase_start = time.time()
+    compact_index(connection, x4t.currentIndexFileName)
+    timings.append(("compact", time.time() - phase_start))
+
+    (
+        coupledReactionEntries,
+        monitoredReactionEntries,
+        reactionCount,
+        buggyEntries,
+    ) = tree_reduce(merge_index_maps, shard_maps)
+    print("Shards merged:", len(shard_dirs))
+    print("\tEntries:", nentries)
+    print("\tsql_transactions:", nrows)
+    print("\tErroneous entries:", len(buggyEntries))
+
+    dump_pickle(coupledReactionEntries, x4t.currentCoupledFileName)
+    dump_pickle(monitoredReactionEntries, x4t.currentMonitoredFileName)
+    dump_pickle(reactionCount, x4t.currentReactionCountFileName)
+    dump_pickle(buggyEntries, x4t.currentErrorFileName)
+    report_phase_timings(timings)
+
 
 def insertDOIIndex(doiFileName="x4doi.txt"):
     """
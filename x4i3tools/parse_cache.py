@@ -0,0 +1,101 @@
+"""
+Content addressed cache of the parsed entries, shared across EXFOR releases.
+
+The index generators store the outputs of ``processEntry`` for every entry
+(its rows of ``theworks``, the coupled/monitored data sets, the reaction
+counts, the parsing error, if any, the BIB text and the year) under the
+content hash of the entry, the versions of x4i3 and x4i3tools and the format
+of the results. Entries that did not change between masters are then not
+parsed again.
+
+Like the entry sources, a cache is handed to the pool workers as part of the
+workpackages. The workers only read from it, the parent process stores the
+entries they had to parse.
+"""
+import pathlib
+
+# Version of the results of ``index_generators.parse_entry``. Increase it
+# whenever they change, results stored in another format are not used.
+result_format = 3
+
+
+def parser_versions():
+    """The (x4i3, x4i3tools, result format) versions the parsed entries depend on."""
+    from importlib.metadata import version
+    import x4i3tools as x4t
+
+    return version("x4i3"), x4t.__version__, result_format
+
+
+class ParseCache:
+    """
+    A sqlite file mapping (content hash, x4i3, x4i3tools, format) to parse
+    results.
+    """
+
+    def __init__(self, cacheFileName):
+        self.cacheFileName = pathlib.Path(cacheFileName).absolute()
+        self.versions = parser_versions()
+
+    def __repr__(self):
+        return "ParseCache({0})".format(self.cacheFileName)
+
+    def create(self):
+        """Create the cache file, in the parent before the pool is started."""
+        import sqlite3
+
+        connection = sqlite3.connect(self.cacheFileName)  # pylint: disable=no-member
+        # Readers in the workers are not blocked by the parent writing
+        connection.execute("pragma journal_mode=wal")
+        columns = [row[1] for row in connection.execute("pragma table_info(parsed)")]
+        if columns and "format" not in columns:
+            # Written before the results had a format version, all stale
+            connection.execute("drop table parsed")
+        connection.execute(
+            """create table if not exists parsed (hash text, x4i3 text, x4i3tools text, format integer, result blob, primary key (hash, x4i3, x4i3tools, format))"""
+        )
+        connection.commit()
+        connection.close()
+
+    def _connect(self, mode):
+        """The sqlite connection of this process, opened ``ro`` or ``rw``."""
+        import sqlite3
+        import x4i3tools as x4t
+
+        return x4t.process_handle(
+            ("parse_cache", self.cacheFileName, mode),
+            lambda: sqlite3.connect(  # pylint: disable=no-member
+                self.cacheFileName.as_uri() + "?mode=" + mode, uri=True
+            ),
+        )
+
+    def get(self, fhash):
+        """
+        The cached (sql_transactions, coupled, monitored, reactionCount, error,
+        bibText, year) of an entry, the fields of index_generators.ParsedEntry
+        as a plain tuple, or None.
+        ``error`` is the (exception, message) tuple of entries that could not
+        be parsed.
+        """
+        import pickle
+
+        row = self._connect("ro").execute(
+            "select result from parsed where hash = ? and x4i3 = ? and x4i3tools = ? and format = ?",
+            (fhash,) + self.versions,
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            # e.g. an exception class that can not be reconstructed, parse again
+            return None
+
+    def store(self, results):
+        """Store a list of (hash, pickled result) in one transaction."""
+        connection = self._connect("rw")
+        connection.executemany(
+            "insert or replace into parsed values(?,?,?,?,?)",
+            [(fhash,) + self.versions + (result,) for fhash, result in results],
+        )
+        connection.commit()
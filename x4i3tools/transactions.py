@@ -0,0 +1,134 @@
+"""
+Single entry/subentry/transaction management: apply the IAEA TRANS files to an
+unpacked database and update its index in place.
+"""
+import os
+
+
+def split_entry(lines):
+    """
+    Split the lines of an entry into the ENTRY record, a dict
+    ``{subentry accnum: lines}`` and the ENDENTRY record. A NOSUBENT record
+    is kept as a subentry consisting only of this record.
+    """
+    header = None
+    footer = None
+    subentries = {}
+    subent = None
+    for line in lines:
+        tag = line[0:11].strip()
+        if tag == "ENTRY":
+            header = line
+        elif tag == "ENDENTRY":
+            footer = line
+        elif tag == "SUBENT":
+            subent = [line]
+            subentries[line[14:22]] = subent
+        elif tag == "NOSUBENT":
+            subent = None
+            subentries[line[14:22]] = [line]
+        elif subent is not None:
+            subent.append(line)
+    return header, subentries, footer
+
+
+def merge_trans_entry(oldLines, transLines):
+    """
+    Apply the version of an entry in a TRANS file to the existing one.
+
+    Subentries in the TRANS file replace or add to the existing subentries, and
+    NOSUBENT records delete them. Returns the lines of the new entry or None if
+    no subentry is left, i.e. the entry has been deleted.
+    """
+    header, subentries, footer = split_entry(transLines)
+    merged = split_entry(oldLines)[1] if oldLines else {}
+    merged.update(subentries)
+
+    body = [line for key in sorted(merged) for line in merged[key]]
+    nsubent = sum(1 for key in merged if merged[key][0].startswith("SUBENT"))
+    if nsubent == 0:
+        return None
+    if footer is None:
+        footer = "ENDENTRY".ljust(11) + "\n"
+    footer = footer[0:11] + str(nsubent).rjust(11) + footer[22:]
+    return [header] + body + [footer]
+
+
+def apply_trans_file(trans_fname):
+    """
+    Apply an IAEA TRANS file to the unpacked tree at ``currentDBPath``.
+
+    Entries in the TRANS file are merged into (or deleted from) the tree, then
+    only these entries are re-indexed: their rows in ``theworks``, their
+    contributions to the coupled/monitored/reaction count/error pickles and
+    the DOI cross references of deleted entries are replaced in place. The
+    previous versions are not parsed again, the index keeps what they
+    contributed. The unpack manifest and change list are updated if the tree
+    has one.
+    """
+    import json
+    import pathlib
+    import x4i3tools as x4t
+    from x4i3tools.entry_sources import DirectoryEntrySource
+    from x4i3tools.fileops import iter_bck_entries, write_manifest
+    from x4i3tools.index_generators import process_file_package, update_index_entries
+
+    dbPath = pathlib.Path(x4t.currentDBPath)
+    if not dbPath.exists():
+        raise IOError("No unpacked tree found at", dbPath, "Consider using --extract.")
+    if not os.path.exists(x4t.currentIndexFileName):
+        raise IOError("No index found at", x4t.currentIndexFileName)
+    entrySource = DirectoryEntrySource(dbPath)
+    if x4t.parse_cache is not None:
+        x4t.parse_cache.create()
+
+    def x4file(accnum):
+        return dbPath / accnum[0:3] / (accnum + ".x4")
+
+    with open(trans_fname, mode="r", encoding="latin1") as trans:
+        transEntries = {entry[0][17:22]: entry for entry in iter_bck_entries(trans)}
+    accnums = sorted(transEntries)
+    existing = [accnum for accnum in accnums if x4file(accnum).exists()]
+    print("Applying", trans_fname, "to", len(accnums), "entries in", dbPath)
+
+    deleted = []
+    for accnum in accnums:
+        oldLines = entrySource.read_lines(accnum) if accnum in existing else None
+        newLines = merge_trans_entry(oldLines, transEntries[accnum])
+        if newLines is None:
+            deleted.append(accnum)
+            if oldLines is not None:
+                os.remove(x4file(accnum))
+            continue
+        x4file(accnum).parent.mkdir(parents=True, exist_ok=True)
+        with open(x4file(accnum), mode="wb") as f:
+            f.write("".join(newLines).encode("latin1"))
+
+    new = process_file_package(
+        (
+            entrySource,
+            [x4file(a) for a in accnums if a not in deleted],
+            x4t.parse_cache,
+        )
+    )
+    if x4t.parse_cache is not None:
+        x4t.parse_cache.store(new.cache_misses)
+    # The reaction counts of the previous versions are taken from the index
+    update_index_entries(accnums, new, deleted)
+
+    if os.path.exists(x4t.currentManifestFileName):
+        with open(x4t.currentManifestFileName, mode="r") as f:
+            oldManifest = json.load(f)["entries"]
+        manifest = {k: v for k, v in oldManifest.items() if k not in deleted}
+        for accnum in accnums:
+            if accnum not in deleted:
+                manifest[accnum] = x4t.content_hash(x4file(accnum).read_bytes())
+        write_manifest(trans_fname, manifest, oldManifest)
+
+    print(
+        "Entries replaced: {0}, added: {1}, deleted: {2}".format(
+            len(set(existing) - set(deleted)),
+            len(set(accnums) - set(existing) - set(deleted)),
+            len(set(deleted) & set(existing)),
+        )
+    )